@@ -7,6 +7,22 @@ import numpy as np
 from streamlit_option_menu import option_menu
 from streamlit_extras.metric_cards import style_metric_cards
 import seaborn as sns
+import io
+import os
+import threading
+import json
+import hashlib
+import zipfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import plotly.io as pio
+import pyarrow as pa
+import pyarrow.parquet as pq
+from functools import partial
+from pathlib import Path
+from pipeline import ANOMALY_BITS
+from query_engine import CovidStore, QueryTooLarge, built_from, read_manifest
+from derived_metrics import DERIVED_METRICS, PER_CAPITA_METRICS, base_columns, per_million_name, with_derived
 
 # =============================================================================
 # PAGE CONFIGURATION
@@ -120,17 +136,636 @@ PLOTLY_TEMPLATE = "plotly_white"
 # =============================================================================
 # DATA LOADING
 # =============================================================================
+DATA_PATH = 'cleaned_covid_data.csv'
+STORE_PATH = 'covid_store'
+
+STORES_KEPT = 2
+
+def get_data_version():
+    # A partitioned store (`python pipeline.py --store covid_store`) is preferred over the CSV,
+    # unless the CSV has been regenerated since the store was built from it.
+    # Either version string identifies a dataset build; a rebuild invalidates every cache keyed on it.
+    manifest = read_manifest(STORE_PATH)
+    if manifest is not None and (built_from(manifest, DATA_PATH) or not os.path.exists(DATA_PATH)):
+        return f"store-{manifest['version']}"
+    try:
+        stat = os.stat(DATA_PATH)
+        return f"csv-{stat.st_size}-{stat.st_mtime_ns}"
+    except FileNotFoundError:
+        return None
+
+class SupersededVersion(Exception):
+    """Raised when a store is requested for a dataset version that is neither open nor current."""
+
+@st.cache_resource
+def get_open_stores():
+    # data_version -> store, oldest first, shared by all sessions
+    return {"lock": threading.Lock(), "stores": {}}
+
+def open_store(data_version):
+    try:
+        # Older cleaned files still carry the engineered columns; derived metrics replace them
+        if data_version and data_version.startswith("store-"):
+            return CovidStore.open(STORE_PATH, exclude=DERIVED_METRICS)
+        data = pd.read_csv(DATA_PATH)
+        data['date'] = pd.to_datetime(data['date'])
+        return CovidStore(data, exclude=DERIVED_METRICS)
+    except FileNotFoundError:
+        st.error("❌ Data file not found. Please run data preprocessing first (`python pipeline.py`).", icon="🚨")
+        st.stop()
+
+def get_store(data_version):
+    # All views query the store; with the store on disk only the queried files and columns are read.
+    # The current version and the one it replaced stay open, so reruns and warm-up jobs started
+    # before a reload finish on their own data; older stores release their scan threads.
+    # Only the current version is ever opened: what is on disk is always the newest data.
+    registry = get_open_stores()
+    with registry["lock"]:
+        stores = registry["stores"]
+        if data_version not in stores:
+            if data_version != get_data_version():
+                raise SupersededVersion(data_version)
+            with st.spinner("Loading data..."):
+                stores[data_version] = open_store(data_version)
+            while len(stores) > STORES_KEPT:
+                stores.pop(next(iter(stores))).close()
+        return stores[data_version]
+
 @st.cache_data
-def load_data():
+def load_catalog(data_version):
+    return get_store(data_version).catalog()
+
+data_version = get_data_version()
+store = get_store(data_version)
+catalog = load_catalog(data_version)
+if data_version and not data_version.startswith("store-") and read_manifest(STORE_PATH) is not None:
+    st.warning(f"⚠️ `{STORE_PATH}` was built from an older `{DATA_PATH}` and is ignored. "
+               f"Rebuild it with `python pipeline.py --store {STORE_PATH}`.")
+if store.excluded:
+    st.warning(f"⚠️ The data was generated by an older pipeline; its stored {', '.join(store.excluded)} "
+               "columns are ignored and recomputed. Regenerate it with `python pipeline.py`.")
+
+# =============================================================================
+# ANOMALY HANDLING
+# =============================================================================
+# Flag bits (ANOMALY_BITS) are shared with pipeline.py, which writes `anomaly_flags`
+ANOMALY_MODES = ["Keep as reported", "Mask", "Redistribute"]
+REDISTRIBUTE_DAYS = 14
+ANOMALY_COLUMNS = ['anomaly_flags'] + list(ANOMALY_BITS) + [bits["smoothed"] for bits in ANOMALY_BITS.values()]
+# Extra days read on both sides of a query so the rolling windows see their neighbours
+ANOMALY_MARGIN_DAYS = 2 * REDISTRIBUTE_DAYS
+
+def spread_backwards(excess, position, days=REDISTRIBUTE_DAYS):
+    # Spread each excess evenly over the `days` rows before it (fewer at the start of a
+    # country's series) using a difference array, so the cost stays linear in rows.
+    flagged = np.flatnonzero(excess)
+    span = np.minimum(days, position[flagged])
+    flagged, span = flagged[span > 0], span[span > 0]
+    share = excess[flagged] / span
+    diff = np.zeros(len(excess) + 1)
+    np.add.at(diff, flagged - span, share)
+    np.add.at(diff, flagged, -share)
+    return np.cumsum(diff)[:-1]
+
+def adjust_anomalies(data, anomaly_mode):
+    # Applied by the store to each location-complete frame it reads
+    data = data.sort_values(['location', 'date']).reset_index(drop=True)
+    flags = data['anomaly_flags'].fillna(0).to_numpy(dtype=np.uint8)
+    position = data.groupby('location', sort=False).cumcount().to_numpy()
+
+    for col, bits in ANOMALY_BITS.items():
+        spikes = (flags & bits["spike"]) != 0
+        negatives = (flags & bits["negative"]) != 0
+        values = data[col].to_numpy(dtype=float)
+        cleaned = np.where(spikes | negatives, np.nan, values)
+
+        if anomaly_mode == "Redistribute":
+            baseline = (
+                pd.Series(cleaned).groupby(data['location'], sort=False)
+                .rolling(REDISTRIBUTE_DAYS, center=True, min_periods=1).median()
+                .droplevel(0).sort_index().fillna(0).to_numpy()
+            )
+            # Negative corrections were already clipped to zero during validation
+            excess = np.where(spikes, np.maximum(values - baseline, 0), 0.0)
+            cleaned = np.where(spikes, baseline, np.where(negatives, 0.0, values)) + spread_backwards(excess, position)
+
+        data[col] = cleaned
+        data[bits["smoothed"]] = (
+            data[col].groupby(data['location'], sort=False)
+            .rolling(7, min_periods=1).mean()
+            .droplevel(0).sort_index()
+        )
+    return data
+
+def anomaly_options(store, anomaly_mode):
+    # Query keyword arguments that apply the selected anomaly handling
+    if anomaly_mode == "Keep as reported" or 'anomaly_flags' not in store.columns:
+        return {}
+    return {
+        "prepare": partial(adjust_anomalies, anomaly_mode=anomaly_mode),
+        "prepare_columns": ANOMALY_COLUMNS,
+        "margin_days": ANOMALY_MARGIN_DAYS
+    }
+
+# =============================================================================
+# KPI ENGINE
+# =============================================================================
+KPI_METRICS = ["total_cases", "total_deaths", "vaccination_rate"]
+COMPARISON_WINDOWS = {"7 days": 7, "30 days": 30, "90 days": 90, "1 year": 365}
+PER_MILLION = 1_000_000
+
+@st.cache_data
+def compute_kpis(data_version, end_date, continent, windows):
+    # Totals at end_date and at end_date - w for every window w, from one scan of the
+    # continent. Every country contributes its last reported value on or before each
+    # date, not only on days it reported.
+    offsets = np.array((0,) + tuple(windows))
+    targets = pd.DatetimeIndex(end_date - pd.to_timedelta(offsets, unit='D'))
+    derived = [col for col in KPI_METRICS if col in DERIVED_METRICS]
+    columns = list(dict.fromkeys([col for col in KPI_METRICS if col not in DERIVED_METRICS] + base_columns(derived) + ['population']))
+    snapshot = with_derived(get_store(data_version).latest_as_of(targets, continent, columns), derived)
+
+    # Per-million totals: reported totals over the population of the countries reporting them
+    population = snapshot['population'].where(snapshot['population'] > 0)
+    for col in ['total_cases', 'total_deaths']:
+        snapshot[f'{col}_population'] = population.where(snapshot[col].notna())
+        snapshot[f'{col}_with_population'] = snapshot[col].where(population.notna())
+
+    grouped = snapshot.groupby('as_of')
+    kpis = pd.DataFrame({
+        'total_cases': grouped['total_cases'].sum(),
+        'total_deaths': grouped['total_deaths'].sum(),
+        'vaccination_rate': grouped['vaccination_rate'].mean(),
+        per_million_name('total_cases'): grouped['total_cases_with_population'].sum() * PER_MILLION / grouped['total_cases_population'].sum(),
+        per_million_name('total_deaths'): grouped['total_deaths_with_population'].sum() * PER_MILLION / grouped['total_deaths_population'].sum()
+    }).reindex(targets)
+    kpis.index = pd.Index(offsets, name='days_ago')
+    kpis[['total_cases', 'total_deaths']] = kpis[['total_cases', 'total_deaths']].fillna(0)
+
+    current = kpis.loc[0]
+    previous = kpis.loc[list(windows)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        deltas = (current - previous) / previous * 100
+    deltas['vaccination_rate'] = current['vaccination_rate'] - previous['vaccination_rate']
+    deltas = deltas.where(previous > 0)
+    return current, deltas
+
+# =============================================================================
+# FORECAST ENGINE
+# =============================================================================
+FORECAST_METRICS = ["new_cases_smoothed", "new_deaths_smoothed"]
+FORECAST_FIT_DAYS = 28
+FORECAST_HORIZON = 14
+FORECAST_Z = 1.96  # 95% prediction interval
+
+@st.cache_data
+def fit_growth_models(data_version, anomaly_mode, end_date, metric):
+    # Log-linear growth, log1p(y) = a + b*t, fitted by least squares to the last
+    # FORECAST_FIT_DAYS of every country at once (countries x days arrays, no per-country loop).
+    store = get_store(data_version)
+    fit_dates = pd.date_range(end_date - pd.Timedelta(days=FORECAST_FIT_DAYS - 1), end_date, freq='D')
+    window = store.scan(fit_dates[0], fit_dates[-1], columns=[metric], **anomaly_options(store, anomaly_mode))
+    grid = window.pivot(index='location', columns='date', values=metric).reindex(columns=fit_dates)
+
+    y = np.log1p(grid.to_numpy(dtype=float).clip(min=0))
+    observed = ~np.isnan(y)
+    y = np.where(observed, y, 0.0)
+    t = np.arange(len(fit_dates), dtype=float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = observed.sum(axis=1)
+        t_mean = (observed * t).sum(axis=1) / n
+        y_mean = y.sum(axis=1) / n
+        t_dev = np.where(observed, t - t_mean[:, None], 0.0)
+        sxx = (t_dev ** 2).sum(axis=1)
+        slope = (t_dev * (y - y_mean[:, None])).sum(axis=1) / sxx
+        intercept = y_mean - slope * t_mean
+        residuals = np.where(observed, y - (intercept[:, None] + slope[:, None] * t), 0.0)
+        sigma = np.sqrt((residuals ** 2).sum(axis=1) / (n - 2))
+
+    params = pd.DataFrame({
+        'intercept': intercept,
+        'slope': slope,
+        'sigma': sigma,
+        'n': n,
+        't_mean': t_mean,
+        'sxx': sxx
+    }, index=grid.index)
+    return params[(params['n'] >= 7) & (params['sxx'] > 0)]
+
+def project_growth(params, end_date, horizon=FORECAST_HORIZON):
+    steps = np.arange(1, horizon + 1)
+    t = FORECAST_FIT_DAYS - 1 + steps
+    coef = {col: params[col].to_numpy()[:, None] for col in params.columns}
+    center = coef['intercept'] + coef['slope'] * t
+    spread = FORECAST_Z * coef['sigma'] * np.sqrt(1 + 1 / coef['n'] + (t - coef['t_mean']) ** 2 / coef['sxx'])
+    return pd.DataFrame({
+        'location': np.repeat(params.index.to_numpy(), horizon),
+        'date': np.tile(end_date + pd.to_timedelta(steps, unit='D'), len(params)),
+        'forecast': np.expm1(center).ravel(),
+        'lower': np.expm1(center - spread).clip(min=0).ravel(),
+        'upper': np.expm1(center + spread).ravel()
+    })
+
+# =============================================================================
+# EXPORT ENGINE
+# =============================================================================
+EXPORT_CHUNK_ROWS = 50_000
+EXPORT_JOB_LIMIT = 16
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet")
+}
+IMAGE_FORMATS = {"PNG": "png", "PDF": "pdf"}
+
+@st.cache_resource(show_spinner=False)
+def find_chrome():
+    # kaleido (>= 1) renders charts in a local Chrome/Chromium, which pip does not install
     try:
-        df = pd.read_csv('cleaned_covid_data.csv')
-        df['date'] = pd.to_datetime(df['date'])
-        return df
+        from choreographer.browsers.chromium import Chromium
+    except ImportError:
+        return None
+    return os.environ.get("BROWSER_PATH") or Chromium.find_browser(skip_local=False)
+
+def iter_export_chunks(frames, chunk_rows=EXPORT_CHUNK_ROWS):
+    # Frames are streamed from the store one file at a time; row slices are views, not copies.
+    for data in frames:
+        for start in range(0, len(data), chunk_rows):
+            yield data.iloc[start:start + chunk_rows]
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def export_filtered_data(data_version, start_date, end_date, continent, file_format):
+    store = get_store(data_version)
+    chunks = iter_export_chunks(store.frames(start_date, end_date, continent))
+    buffer = io.BytesIO()
+    if file_format == "CSV":
+        text = io.TextIOWrapper(buffer, encoding="utf-8", newline="")
+        text.write(",".join(store.columns) + "\n")
+        for chunk in chunks:
+            chunk[store.columns].to_csv(text, index=False, header=False)
+        text.flush()
+        text.detach()
+    else:
+        schema = store.arrow_schema()
+        with pq.ParquetWriter(buffer, schema) as writer:
+            for chunk in chunks:
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+    return buffer.getvalue()
+
+def render_figures(figure_specs, image_format):
+    # Runs on the export worker pool; each figure becomes one file in a zip archive.
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, spec in figure_specs.items():
+            image = pio.to_image(embed_geometry(pio.from_json(spec)), format=image_format, width=1200, height=700)
+            archive.writestr(f"{name}.{image_format}", image)
+    return buffer.getvalue()
+
+@st.cache_resource
+def get_export_pool():
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="chart-export")
+
+@st.cache_resource
+def get_export_jobs():
+    # Shared across sessions: identical exports reuse the same rendered archive.
+    return {}
+
+def submit_figure_export(filter_key, figures, image_format):
+    figure_specs = {name: fig.to_json() for name, fig in figures.items()}
+    digest = hashlib.sha1(json.dumps([filter_key, image_format, figure_specs], default=str).encode()).hexdigest()
+    jobs = get_export_jobs()
+    if digest not in jobs:
+        while len(jobs) >= EXPORT_JOB_LIMIT:
+            jobs.pop(next(iter(jobs)))
+        jobs[digest] = get_export_pool().submit(render_figures, figure_specs, image_format)
+    return digest
+
+# =============================================================================
+# SIMILARITY INDEX
+# =============================================================================
+SIMILARITY_METRICS = ["new_cases_smoothed", "new_deaths_smoothed"]
+SIMILARITY_POINTS = 64
+SIMILARITY_COMPONENTS = 16
+
+class TrajectoryIndex:
+    # Per-million daily trajectories (metric x date x country) for every country.
+    # Queries slice any date window, resample it to SIMILARITY_POINTS bins and rank
+    # countries by distance to the reference curve. The grid is dense and held in
+    # float32: 8 bytes per country and day (about 2.5 MB for 250 countries over
+    # 3.5 years, 50 MB for 5,000 sub-national regions).
+
+    def __init__(self):
+        self.version = None
+        # (dates, locations, values), replaced as a whole so queries never see a half-built index
+        self.state = (pd.DatetimeIndex([]), np.array([], dtype=object), np.zeros((len(SIMILARITY_METRICS), 0, 0), dtype=np.float32))
+        # Per-location row count, date span and column sums of the indexed data
+        self.fingerprints = pd.DataFrame()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _grid(data, dates, locations):
+        frame = data[['date', 'location']].copy()
+        population = data['population'].where(data['population'] > 0).to_numpy(dtype=float)
+        frame[SIMILARITY_METRICS] = data[SIMILARITY_METRICS].to_numpy(dtype=float) / population[:, None] * 1_000_000
+        columns = pd.MultiIndex.from_product([SIMILARITY_METRICS, locations])
+        wide = frame.pivot(index='date', columns='location', values=SIMILARITY_METRICS).reindex(index=dates, columns=columns)
+        grid = np.nan_to_num(wide.to_numpy(dtype=float), nan=0.0).clip(min=0)
+        return grid.reshape(len(dates), len(SIMILARITY_METRICS), len(locations)).transpose(1, 0, 2)
+
+    @staticmethod
+    def _fingerprint(data):
+        # Any revised, added or removed row changes at least one of these
+        grouped = data.groupby('location')
+        return pd.concat([grouped['date'].agg(['size', 'min', 'max']),
+                          grouped[['population'] + SIMILARITY_METRICS].sum()], axis=1)
+
+    def refresh(self, store, catalog, version):
+        # One projected scan; only countries whose fingerprint changed are re-pivoted,
+        # the rest are copied from the current index onto the new date axis.
+        with self._lock:
+            if version == self.version:
+                return
+            old_dates, old_locations, old_values = self.state
+            dates = pd.date_range(catalog['first_date'].min(), catalog['last_date'].max(), freq='D')
+            locations = np.array(sorted(catalog['location'].unique()), dtype=object)
+            values = np.zeros((len(SIMILARITY_METRICS), len(dates), len(locations)), dtype=np.float32)
+            metrics = np.arange(len(SIMILARITY_METRICS))
+            old_rows = old_dates.get_indexer(dates)
+            rows = np.flatnonzero(old_rows >= 0)
+
+            fingerprints = []
+            for frame in store.frames(None, None, columns=['population'] + SIMILARITY_METRICS):
+                if frame.empty:
+                    continue
+                fingerprint = self._fingerprint(frame)
+                fingerprints.append(fingerprint)
+                previous = self.fingerprints.reindex(index=fingerprint.index, columns=fingerprint.columns)
+                unchanged = fingerprint.index[fingerprint.eq(previous).all(axis=1)]
+                changed = fingerprint.index.difference(unchanged)
+                if len(unchanged):
+                    values[np.ix_(metrics, rows, locations.searchsorted(unchanged))] = \
+                        old_values[np.ix_(metrics, old_rows[rows], pd.Index(old_locations).get_indexer(unchanged))]
+                if len(changed):
+                    values[:, :, locations.searchsorted(changed)] = \
+                        self._grid(frame[frame['location'].isin(changed)], dates, changed)
+
+            # Countries no longer in the store are dropped with the old state
+            self.state = (dates, locations, values)
+            self.fingerprints = pd.concat(fingerprints) if fingerprints else pd.DataFrame()
+            self.version = version
+
+    @staticmethod
+    def _window(dates, start_date, end_date):
+        return slice(dates.searchsorted(start_date), dates.searchsorted(end_date, side='right'))
+
+    def _features(self, window):
+        # Bin means via the cumulative sum, interpolated at fractional bin edges (metric x bin x country).
+        n_days = window.shape[1]
+        cumulative = np.concatenate([np.zeros_like(window[:, :1]), window.cumsum(axis=1)], axis=1)
+        edges = np.linspace(0, n_days, SIMILARITY_POINTS + 1)
+        base = np.floor(edges).astype(int).clip(max=n_days - 1)
+        at_edges = cumulative[:, base] + (edges - base)[None, :, None] * window[:, base]
+        binned = np.log1p(np.diff(at_edges, axis=1) / np.diff(edges)[None, :, None])
+        # Equal weight for each metric regardless of its scale
+        scale = binned.std(axis=(1, 2), keepdims=True)
+        binned = binned / np.where(scale > 0, scale, 1.0)
+        return binned.transpose(2, 0, 1).reshape(binned.shape[2], -1)
+
+    def query(self, location, start_date, end_date, k=5, reduce=True):
+        dates, locations, values = self.state
+        window = values[:, self._window(dates, start_date, end_date)].astype(float)
+        matches = np.flatnonzero(locations == location)
+        if window.shape[1] < 2 or not len(matches):
+            return pd.DataFrame(columns=['location', 'distance'])
+        features = self._features(window)
+        reported = window.sum(axis=(0, 1)) > 0
+        if reduce:
+            centered = features - features[reported].mean(axis=0)
+            _, _, components = np.linalg.svd(centered[reported], full_matrices=False)
+            features = centered @ components[:SIMILARITY_COMPONENTS].T
+        distances = np.sqrt(((features - features[matches[0]]) ** 2).sum(axis=1))
+        distances[~reported | (locations == location)] = np.inf
+        k = min(k, int(np.isfinite(distances).sum()))
+        nearest = np.argpartition(distances, k - 1)[:k] if k > 0 else np.array([], dtype=int)
+        nearest = nearest[np.argsort(distances[nearest])]
+        return pd.DataFrame({'location': locations[nearest], 'distance': distances[nearest]})
+
+    def trajectories(self, selected, start_date, end_date, metric='new_cases_smoothed'):
+        dates, locations, values = self.state
+        rows = self._window(dates, start_date, end_date)
+        columns = np.flatnonzero(np.isin(locations, selected))
+        curves = pd.DataFrame(values[SIMILARITY_METRICS.index(metric), rows][:, columns],
+                              index=dates[rows], columns=locations[columns])
+        return curves.rename_axis('date').reset_index().melt(id_vars='date', var_name='location', value_name=per_million_name(metric))
+
+@st.cache_resource
+def get_trajectory_index():
+    return TrajectoryIndex()
+
+trajectory_index = get_trajectory_index()
+
+# =============================================================================
+# DATA QUERIES
+# =============================================================================
+# Shared by the views and the cache warmer; every query is keyed on the dataset
+# version and the sidebar filter.
+# Derived metrics the views read; evaluated on the query result, so they are cached with it.
+# The per-million variants back the Per Capita View, so toggling it only switches columns.
+VIEW_METRICS = ("vaccination_rate", "mortality_rate") + tuple(per_million_name(col) for col in PER_CAPITA_METRICS)
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def query_latest_global(data_version, anomaly_mode, start_date, end_date, continent, derived=VIEW_METRICS):
+    store = get_store(data_version)
+    latest = store.latest(start_date, end_date, continent, **anomaly_options(store, anomaly_mode))
+    return with_derived(latest, derived)
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def query_trend_df(data_version, anomaly_mode, start_date, end_date, continent, locations, derived=VIEW_METRICS):
+    store = get_store(data_version)
+    trend = store.scan(start_date, end_date, continent, locations=list(locations), **anomaly_options(store, anomaly_mode))
+    return with_derived(trend, derived)
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def query_global_timeline(data_version, anomaly_mode, start_date, end_date, continent):
+    store = get_store(data_version)
+    values = ['new_cases', 'new_deaths', 'new_cases_smoothed']
+    return store.daily_totals(values, start_date, end_date, continent, **anomaly_options(store, anomaly_mode))
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def query_monthly_heatmap(data_version, anomaly_mode, start_date, end_date, continent, top_n=15):
+    store = get_store(data_version)
+    heatmap_countries = store.top_locations('total_cases', top_n, start_date, end_date, continent)
+    return store.monthly_totals('new_cases', heatmap_countries, start_date, end_date, continent,
+                                **anomaly_options(store, anomaly_mode))
+
+# =============================================================================
+# MAP GEOMETRY
+# =============================================================================
+# Simplified ISO3-keyed world outlines built by `python geometry.py` and served from
+# static/ by Streamlit (.streamlit/config.toml), so maps need no CDN. Figures only
+# reference the file URL: the browser downloads it once and every map reuses it.
+GEOMETRY_DIR = 'static'
+GEOMETRY_URL = 'app/static'
+# plotly.js fetches its base-layer TopoJSON (world_110m.json) for every geo plot whose
+# traces have a locationmode, GeoJSON choropleths included; serve it from static/ too
+PLOTLY_CONFIG = {"topojsonURL": f"{GEOMETRY_URL}/"}
+# Image export renders in kaleido's own Chrome, which reads the same file from disk
+pio.defaults.topojson = f"{Path(GEOMETRY_DIR).resolve().as_uri()}/"
+DEFAULT_GEOMETRY_LEVEL = 'medium'
+
+@st.cache_data
+def load_geometry_levels():
+    try:
+        with open(os.path.join(GEOMETRY_DIR, 'world-levels.json')) as handle:
+            return json.load(handle)
     except FileNotFoundError:
-        st.error("❌ Data file not found. Please run data preprocessing first.", icon="🚨")
+        st.error("❌ Map geometry not found. Please build it first (`python geometry.py --source <countries.geojson>`).", icon="🚨")
         st.stop()
 
-df = load_data()
+@st.cache_data
+def load_label_points():
+    # Label points for countries too small for the outlines at some level (optional file)
+    try:
+        with open(os.path.join(GEOMETRY_DIR, 'world-points.json')) as handle:
+            points = json.load(handle)
+    except FileNotFoundError:
+        points = {}
+    return pd.DataFrame(
+        [(iso, point['lat'], point['lon']) for iso, point in points.items()],
+        columns=['iso_code', 'lat', 'lon']
+    ).set_index('iso_code')
+
+@st.cache_resource
+def load_geometry(level):
+    # Parsed once per level: label points for bubble maps, full outlines for static image export.
+    # `outline` marks countries drawn by the level; the rest only have a label point.
+    with open(os.path.join(GEOMETRY_DIR, load_geometry_levels()[level]['file'])) as handle:
+        geometry = json.load(handle)
+    centroids = pd.DataFrame(
+        [(feature['id'], feature['properties']['lat'], feature['properties']['lon']) for feature in geometry['features']],
+        columns=['iso_code', 'lat', 'lon']
+    ).set_index('iso_code').assign(outline=True)
+    points = load_label_points()
+    points = points[~points.index.isin(centroids.index)].assign(outline=False)
+    return geometry, pd.concat([centroids, points])
+
+def geometry_url(level):
+    return f"{GEOMETRY_URL}/{load_geometry_levels()[level]['file']}"
+
+def embed_geometry(fig):
+    # Image export has no browser to fetch the geometry URL, so inline the outlines
+    files = {geometry_url(level): level for level in load_geometry_levels()}
+    for trace in fig.data:
+        if isinstance(getattr(trace, 'geojson', None), str) and trace.geojson in files:
+            trace.geojson = load_geometry(files[trace.geojson])[0]
+    return fig
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def query_map_frame(data_version, anomaly_mode, start_date, end_date, continent, level):
+    # Latest rows joined to the geometry once per filter: only countries that can be drawn,
+    # as an outline or at least as a label point for bubble maps
+    latest = query_latest_global(data_version, anomaly_mode, start_date, end_date, continent)
+    return latest.join(load_geometry(level)[1], on='iso_code', how='inner')
+
+def world_map(fig, level):
+    # Grey land under the data traces, drawn from the same bundled outlines;
+    # Plotly's own base layers are hidden because they are fetched from its CDN.
+    _, centroids = load_geometry(level)
+    outlined = centroids.index[centroids['outline']]
+    land = go.Choropleth(
+        geojson=geometry_url(level),
+        featureidkey="id",
+        locations=outlined,
+        z=np.zeros(len(outlined)),
+        colorscale=[[0, "#e2e8f0"], [1, "#e2e8f0"]],
+        showscale=False,
+        hoverinfo="skip",
+        marker_line_color="#cbd5e1",
+        marker_line_width=0.5
+    )
+    fig.add_trace(land)
+    fig.data = fig.data[-1:] + fig.data[:-1]
+    # Always the whole world; newer plotly.js defaults to fitting the locations
+    fig.update_geos(visible=False, projection_type="natural earth", fitbounds=False)
+    return fig
+
+# =============================================================================
+# CACHE WARMING
+# =============================================================================
+DEFAULT_COUNTRIES = ["United States", "United Kingdom", "India", "Germany", "Brazil"]
+DEFAULT_WINDOW_DAYS = 365
+WARMUP_WORKERS = 4
+PREFETCH_TOP = 8
+
+def default_selection(catalog):
+    # Mirrors the sidebar defaults: last year, all continents, smoothed new cases
+    end_date = pd.to_datetime(catalog['last_date'].max().date())
+    return (end_date - pd.Timedelta(days=DEFAULT_WINDOW_DAYS), end_date, 'All', 'new_cases_smoothed')
+
+def default_countries(catalog, continent):
+    # Mirrors the Focus Countries default for a continent
+    locations = catalog['location'] if continent == 'All' else catalog.loc[catalog['continent'] == continent, 'location']
+    available = sorted(locations.unique())
+    defaults = [c for c in DEFAULT_COUNTRIES if c in available][:5]
+    return defaults if defaults else available[:5]
+
+def warm_selection(data_version, start_date, end_date, continent, metric):
+    anomaly_mode = ANOMALY_MODES[0]
+    steps = [
+        partial(query_trend_df, data_version, anomaly_mode, start_date, end_date, continent,
+                tuple(default_countries(load_catalog(data_version), continent))),
+        partial(query_latest_global, data_version, anomaly_mode, start_date, end_date, continent),
+        partial(query_global_timeline, data_version, anomaly_mode, start_date, end_date, continent),
+        partial(query_monthly_heatmap, data_version, anomaly_mode, start_date, end_date, continent),
+        partial(query_map_frame, data_version, anomaly_mode, start_date, end_date, continent, DEFAULT_GEOMETRY_LEVEL),
+        partial(compute_kpis, data_version, end_date, continent, tuple(COMPARISON_WINDOWS.values()))
+    ]
+    if metric in FORECAST_METRICS:
+        steps.append(partial(fit_growth_models, data_version, anomaly_mode, end_date, metric))
+    for step in steps:
+        # Work for a dataset that has since been reloaded is dropped; the new version warms itself
+        if data_version != get_data_version():
+            return
+        try:
+            step()
+        except (QueryTooLarge, SupersededVersion):
+            pass
+
+def refresh_index(data_version):
+    if data_version == get_data_version():
+        get_trajectory_index().refresh(get_store(data_version), load_catalog(data_version), data_version)
+
+@st.cache_resource
+def get_warmup_pool():
+    return ThreadPoolExecutor(max_workers=WARMUP_WORKERS, thread_name_prefix="cache-warmup")
+
+@st.cache_resource
+def get_selection_stats():
+    # (start_date, end_date, continent, metric) -> request count, shared by all sessions
+    return {"lock": threading.Lock(), "counts": Counter()}
+
+def record_selection(selection):
+    stats = get_selection_stats()
+    with stats["lock"]:
+        stats["counts"][selection] += 1
+
+def popular_selections(limit=PREFETCH_TOP):
+    stats = get_selection_stats()
+    with stats["lock"]:
+        return [selection for selection, _ in stats["counts"].most_common(limit)]
+
+@st.cache_resource(show_spinner=False)
+def start_warmup(data_version):
+    # Runs once per dataset version, i.e. on the first run after startup and after each
+    # dataset reload: the similarity index and the defaults first, then the most
+    # requested selections.
+    catalog = load_catalog(data_version)
+    selections = [default_selection(catalog)] + popular_selections()
+    pool = get_warmup_pool()
+    index_job = pool.submit(refresh_index, data_version)
+    return [index_job] + [pool.submit(warm_selection, data_version, *selection) for selection in dict.fromkeys(selections)]
+
+start_warmup(data_version)
 
 # =============================================================================
 # SIDEBAR CONTROLS
@@ -141,12 +776,12 @@ with st.sidebar:
     
     # Date Range Filter
     st.markdown("### 📅 Time Period")
-    min_date = df['date'].min().date()
-    max_date = df['date'].max().date()
+    min_date = catalog['first_date'].min().date()
+    max_date = catalog['last_date'].max().date()
     
     date_range = st.date_input(
         "Select Date Range",
-        value=[max_date - pd.Timedelta(days=365), max_date],
+        value=[max_date - pd.Timedelta(days=DEFAULT_WINDOW_DAYS), max_date],
         min_value=min_date,
         max_value=max_date,
         key="date_range"
@@ -161,22 +796,18 @@ with st.sidebar:
     
     # Geography Filter
     st.markdown("### 🌍 Geography")
-    all_continents = ['All'] + sorted(df['continent'].dropna().unique().tolist())
+    all_continents = ['All'] + sorted(catalog['continent'].dropna().unique().tolist())
     selected_continent = st.selectbox("Continent", all_continents)
     
     if selected_continent != 'All':
-        available_countries = sorted(df[df['continent'] == selected_continent]['location'].unique())
+        available_countries = sorted(catalog[catalog['continent'] == selected_continent]['location'].unique())
     else:
-        available_countries = sorted(df['location'].unique())
-    
-    # Smart defaults
-    default_countries = ["United States", "United Kingdom", "India", "Germany", "Brazil"]
-    final_defaults = [c for c in default_countries if c in available_countries][:5]
+        available_countries = sorted(catalog['location'].unique())
     
     selected_countries = st.multiselect(
         "Focus Countries",
         available_countries,
-        default=final_defaults if final_defaults else available_countries[:5]
+        default=default_countries(catalog, selected_continent)
     )
     
     st.info("💡 Maps show ALL countries. Country selection filters comparison charts.")
@@ -187,21 +818,52 @@ with st.sidebar:
     st.markdown("### ⚙️ Options")
     show_log_scale = st.checkbox("Logarithmic Scale", value=False)
     show_per_capita = st.checkbox("Per Capita View", value=False)
+    geometry_levels = list(load_geometry_levels())
+    map_detail = st.select_slider(
+        "Map Detail",
+        geometry_levels,
+        value=DEFAULT_GEOMETRY_LEVEL if DEFAULT_GEOMETRY_LEVEL in geometry_levels else geometry_levels[-1],
+        format_func=str.title,
+        help="Simplification level of the bundled country outlines; coarser levels load faster."
+    )
+    anomaly_mode = st.selectbox(
+        "Reporting Anomalies",
+        ANOMALY_MODES,
+        help="Spikes and negative corrections flagged during preprocessing can be masked, or spread back over the preceding days."
+    )
 
 # Filter Data
-global_mask = (df['date'] >= start_date) & (df['date'] <= end_date)
-if selected_continent != 'All':
-    global_mask = global_mask & (df['continent'] == selected_continent)
-
-global_df = df[global_mask].copy()
+data_filter = (data_version, anomaly_mode, start_date, end_date, selected_continent)
+latest_global = query_latest_global(*data_filter)
+map_df = query_map_frame(*data_filter, map_detail)
 
 if selected_countries:
-    trend_df = global_df[global_df['location'].isin(selected_countries)]
+    trend_countries = tuple(selected_countries)
 else:
-    top_countries = global_df.groupby('location')['total_cases'].max().nlargest(5).index
-    trend_df = global_df[global_df['location'].isin(top_countries)]
+    trend_countries = tuple(latest_global.nlargest(5, 'total_cases')['location'])
+
+try:
+    trend_df = query_trend_df(*data_filter, trend_countries)
+except QueryTooLarge as exc:
+    st.error(f"❌ {exc}", icon="🚨")
+    st.stop()
+
+def per_capita(column):
+    # Column shown for `column`: its per-million variant when the Per Capita View is on
+    normalized = per_million_name(column)
+    return normalized if show_per_capita and normalized in DERIVED_METRICS else column
+
+def per_capita_label(label, column):
+    return f"{label} per Million" if per_capita(column) != column else label
+
+# Figures rendered in the current tab, collected for image export
+tab_figures = {}
+# Metric the current view is built around, recorded for prefetching
+requested_metric = None
 
-latest_global = global_df.sort_values('date').groupby('location').last().reset_index()
+def show_chart(fig, name):
+    tab_figures[name] = fig
+    st.plotly_chart(fig, use_container_width=True, config=PLOTLY_CONFIG)
 
 # =============================================================================
 # NAVIGATION
@@ -242,34 +904,37 @@ if selected_tab == "📊 Overview":
     st.markdown("Global COVID-19 pandemic insights at a glance")
     st.markdown("<br>", unsafe_allow_html=True)
     
+    # Comparison period for KPI deltas
+    comparison_label = st.radio(
+        "Compare against",
+        list(COMPARISON_WINDOWS.keys()),
+        index=1,
+        horizontal=True,
+        key="kpi_window"
+    )
+    comparison_days = COMPARISON_WINDOWS[comparison_label]
+
     # KPI Cards
     col1, col2, col3, col4 = st.columns(4)
-    
-    # Calculate metrics
-    total_cases = latest_global['total_cases'].sum()
-    total_deaths = latest_global['total_deaths'].sum()
-    avg_vax_rate = latest_global['vaccination_rate'].mean()
+
+    # Calculate metrics (all comparison windows in one vectorized pass)
+    kpi_current, kpi_deltas = compute_kpis(data_version, end_date, selected_continent, tuple(COMPARISON_WINDOWS.values()))
+    cases_col, deaths_col = per_capita('total_cases'), per_capita('total_deaths')
+    total_cases = kpi_current[cases_col]
+    total_deaths = kpi_current[deaths_col]
+    avg_vax_rate = kpi_current['vaccination_rate']
     countries_tracked = latest_global['location'].nunique()
-    
-    # Delta calculation (vs 30 days ago)
-    date_30_ago = end_date - pd.Timedelta(days=30)
-    past_data = global_df[global_df['date'] <= date_30_ago]
-    if not past_data.empty:
-        past_latest = past_data[past_data['date'] == past_data['date'].max()]
-        prev_cases = past_latest['total_cases'].sum()
-        prev_deaths = past_latest['total_deaths'].sum()
-        prev_vax = past_latest['vaccination_rate'].mean()
-        
-        cases_delta = f"+{((total_cases - prev_cases) / prev_cases * 100):.1f}%" if prev_cases > 0 else None
-        deaths_delta = f"+{((total_deaths - prev_deaths) / prev_deaths * 100):.1f}%" if prev_deaths > 0 else None
-        vax_delta = f"+{(avg_vax_rate - prev_vax):.1f}%" if prev_vax > 0 else None
-    else:
-        cases_delta = deaths_delta = vax_delta = None
-    
+
+    # Delta vs the selected comparison period
+    period_deltas = kpi_deltas.loc[comparison_days]
+    cases_delta = f"{period_deltas[cases_col]:+.1f}% vs {comparison_label} ago" if pd.notna(period_deltas[cases_col]) else None
+    deaths_delta = f"{period_deltas[deaths_col]:+.1f}% vs {comparison_label} ago" if pd.notna(period_deltas[deaths_col]) else None
+    vax_delta = f"{period_deltas['vaccination_rate']:+.1f} pts vs {comparison_label} ago" if pd.notna(period_deltas['vaccination_rate']) else None
+
     with col1:
-        st.metric("🦠 Total Cases", f"{total_cases:,.0f}", delta=cases_delta)
+        st.metric(per_capita_label("🦠 Total Cases", 'total_cases'), f"{total_cases:,.0f}", delta=cases_delta)
     with col2:
-        st.metric("💀 Total Deaths", f"{total_deaths:,.0f}", delta=deaths_delta, delta_color="inverse")
+        st.metric(per_capita_label("💀 Total Deaths", 'total_deaths'), f"{total_deaths:,.0f}", delta=deaths_delta, delta_color="inverse")
     with col3:
         st.metric("💉 Avg Vaccination Rate", f"{avg_vax_rate:.1f}%", delta=vax_delta)
     with col4:
@@ -291,10 +956,13 @@ if selected_tab == "📊 Overview":
             "Cases per Million": "total_cases_per_million"
         }
         selected_metric = st.selectbox("Select Metric", list(metric_options.keys()), key="map_metric")
-        metric_col = metric_options[selected_metric]
+        requested_metric = metric_options[selected_metric]
+        metric_col = per_capita(requested_metric)
         
         fig_map = px.choropleth(
-            latest_global,
+            map_df,
+            geojson=geometry_url(map_detail),
+            featureidkey="id",
             locations="iso_code",
             color=metric_col,
             hover_name="location",
@@ -320,12 +988,12 @@ if selected_tab == "📊 Overview":
                 showlakes=False
             ),
             coloraxis_colorbar=dict(
-                title=selected_metric,
+                title=per_capita_label(selected_metric, requested_metric),
                 thickness=15,
                 len=0.7
             )
         )
-        st.plotly_chart(fig_map, use_container_width=True)
+        show_chart(world_map(fig_map, map_detail), "map")
     
     # 4.3 Top Rankings
     with col_chart: # Changed col_bar to col_chart
@@ -352,16 +1020,12 @@ if selected_tab == "📊 Overview":
         )
         fig_bar.update_yaxes(title="", tickfont=dict(color="#334155"))
         fig_bar.update_xaxes(tickfont=dict(color="#334155"))
-        st.plotly_chart(fig_bar, use_container_width=True)
+        show_chart(fig_bar, "bar")
     
     # Secondary Row: Timeline
     st.markdown("### 📈 Global Timeline")
     
-    global_timeline = global_df.groupby('date').agg({
-        'new_cases': 'sum',
-        'new_deaths': 'sum',
-        'new_cases_smoothed': 'sum'
-    }).reset_index()
+    global_timeline = query_global_timeline(*data_filter)
     
     fig_timeline = go.Figure()
     fig_timeline.add_trace(go.Scatter(
@@ -385,7 +1049,7 @@ if selected_tab == "📊 Overview":
         legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1)
     )
     
-    st.plotly_chart(fig_timeline, use_container_width=True)
+    show_chart(fig_timeline, "timeline")
 
 # =============================================================================
 # VIEW 2: TRENDS & EVOLUTION
@@ -405,8 +1069,18 @@ elif selected_tab == "📈 Trends":
         "Reproduction Rate": "reproduction_rate"
     }
     
-    selected_trend = st.selectbox("Select Metric", list(trend_metrics.keys()))
-    trend_col = trend_metrics[selected_trend]
+    col_metric, col_forecast = st.columns([3, 1])
+    with col_metric:
+        selected_trend = st.selectbox("Select Metric", list(trend_metrics.keys()))
+    requested_metric = trend_metrics[selected_trend]
+    trend_col = per_capita(requested_metric)
+    with col_forecast:
+        show_forecast = st.checkbox(
+            f"{FORECAST_HORIZON}-day Forecast",
+            value=False,
+            disabled=requested_metric not in FORECAST_METRICS,
+            help="Log-linear growth fitted to the last 28 days of the smoothed series, with a 95% interval."
+        )
     
     # Main Trend Line Chart
     fig_trend = px.line(
@@ -414,7 +1088,7 @@ elif selected_tab == "📈 Trends":
         x="date",
         y=trend_col,
         color="location",
-        title=f"{selected_trend} Over Time",
+        title=f"{per_capita_label(selected_trend, requested_metric)} Over Time",
         template=PLOTLY_TEMPLATE,
         color_discrete_sequence=px.colors.qualitative.Vivid,
         log_y=show_log_scale
@@ -426,7 +1100,38 @@ elif selected_tab == "📈 Trends":
         plot_bgcolor="rgba(0,0,0,0)",
         legend=dict(orientation="h", yanchor="bottom", y=-0.3, xanchor="left", x=0)
     )
-    st.plotly_chart(fig_trend, use_container_width=True)
+
+    # Forecast traces (all shown countries projected in one batched call)
+    if show_forecast and requested_metric in FORECAST_METRICS:
+        growth_params = fit_growth_models(data_version, anomaly_mode, end_date, requested_metric)
+        shown = [location for location in trend_df['location'].unique() if location in growth_params.index]
+        projection = project_growth(growth_params.loc[shown], end_date)
+        if trend_col != requested_metric:
+            population = trend_df.groupby('location')['population'].last()
+            scale = (PER_MILLION / population.where(population > 0)).reindex(projection['location']).to_numpy()
+            projection[['forecast', 'lower', 'upper']] *= scale[:, None]
+        trace_colors = {trace.name: trace.line.color for trace in fig_trend.data}
+        for location, path in projection.groupby('location', sort=False):
+            color = trace_colors.get(location)
+            fig_trend.add_trace(go.Scatter(
+                x=pd.concat([path['date'], path['date'][::-1]]),
+                y=pd.concat([path['upper'], path['lower'][::-1]]),
+                fill='toself',
+                fillcolor=color,
+                opacity=0.15,
+                line=dict(width=0),
+                hoverinfo='skip',
+                showlegend=False,
+                legendgroup=location
+            ))
+            fig_trend.add_trace(go.Scatter(
+                x=path['date'],
+                y=path['forecast'],
+                name=f"{location} (forecast)",
+                line=dict(color=color, dash='dash'),
+                legendgroup=location
+            ))
+    show_chart(fig_trend, "trend")
     
     # Secondary Charts
     col1, col2 = st.columns(2)
@@ -446,7 +1151,7 @@ elif selected_tab == "📈 Trends":
             paper_bgcolor="rgba(0,0,0,0)",
             showlegend=False
         )
-        st.plotly_chart(fig_area, use_container_width=True)
+        show_chart(fig_area, "area")
     
     with col2:
         st.markdown("### 💉 Vaccination Progress")
@@ -464,7 +1169,7 @@ elif selected_tab == "📈 Trends":
             showlegend=False,
             yaxis_title="Vaccination Rate (%)"
         )
-        st.plotly_chart(fig_vax, use_container_width=True)
+        show_chart(fig_vax, "vax")
     
     # Rolling Average Analysis
     st.markdown("### 📉 7-Day Rolling Averages")
@@ -487,7 +1192,7 @@ elif selected_tab == "📈 Trends":
             template=PLOTLY_TEMPLATE
         )
         fig_roll_cases.update_layout(height=300, paper_bgcolor="rgba(0,0,0,0)")
-        st.plotly_chart(fig_roll_cases, use_container_width=True)
+        show_chart(fig_roll_cases, "roll_cases")
     
     with col4:
         # Deaths Rolling Average
@@ -500,7 +1205,51 @@ elif selected_tab == "📈 Trends":
             template=PLOTLY_TEMPLATE
         )
         fig_roll_deaths.update_layout(height=300, paper_bgcolor="rgba(0,0,0,0)")
-        st.plotly_chart(fig_roll_deaths, use_container_width=True)
+        show_chart(fig_roll_deaths, "roll_deaths")
+
+    # Similarity Search
+    st.markdown("### 🧭 Countries with Similar Curves")
+
+    # The warm-up pool refreshes the index; this only waits if that is still running
+    with st.spinner("Indexing trajectories..."):
+        trajectory_index.refresh(store, catalog, data_version)
+
+    col5, col6, col7 = st.columns([2, 1, 1])
+    index_locations = list(trajectory_index.state[1])
+    reference_default = selected_countries[0] if selected_countries and selected_countries[0] in index_locations else index_locations[0]
+    with col5:
+        reference_country = st.selectbox("Reference Country", index_locations, index=index_locations.index(reference_default), key="similar_reference")
+    with col6:
+        neighbour_count = st.slider("Matches", min_value=3, max_value=10, value=5, key="similar_k")
+    with col7:
+        reduce_dims = st.checkbox("PCA-reduced", value=True, key="similar_pca")
+
+    similar = trajectory_index.query(reference_country, start_date, end_date, k=neighbour_count, reduce=reduce_dims)
+    if similar.empty:
+        st.warning("Not enough data in the selected period for a similarity search.")
+    else:
+        curves = trajectory_index.trajectories([reference_country] + similar['location'].tolist(), start_date, end_date)
+        fig_similar = px.line(
+            curves,
+            x="date",
+            y=per_million_name("new_cases_smoothed"),
+            color="location",
+            title=f"New Cases per Million - {reference_country} vs Closest Matches",
+            template=PLOTLY_TEMPLATE,
+            color_discrete_sequence=px.colors.qualitative.Vivid,
+            log_y=show_log_scale
+        )
+        fig_similar.update_traces(line=dict(width=1.5))
+        fig_similar.update_traces(selector=dict(name=reference_country), line=dict(width=4))
+        fig_similar.update_layout(
+            height=400,
+            hovermode="x unified",
+            paper_bgcolor="rgba(0,0,0,0)",
+            plot_bgcolor="rgba(0,0,0,0)",
+            yaxis_title="New Cases per Million (7-day avg)"
+        )
+        show_chart(fig_similar, "similar")
+        st.dataframe(similar.rename(columns={'location': 'Country', 'distance': 'Distance'}), hide_index=True, use_container_width=True)
 
 # =============================================================================
 # VIEW 3: GEOGRAPHIC ANALYSIS
@@ -514,11 +1263,13 @@ elif selected_tab == "🗺️ Geographic":
     col1, col2 = st.columns(2)
     
     with col1:
-        st.markdown("### 🦠 Total Cases by Country")
+        st.markdown(f"### 🦠 {per_capita_label('Total Cases', 'total_cases')} by Country")
         fig_map1 = px.choropleth(
-            latest_global,
+            map_df,
+            geojson=geometry_url(map_detail),
+            featureidkey="id",
             locations="iso_code",
-            color="total_cases",
+            color=per_capita("total_cases"),
             hover_name="location",
             color_continuous_scale="Reds",
             template=PLOTLY_TEMPLATE,
@@ -537,12 +1288,14 @@ elif selected_tab == "🗺️ Geographic":
             ),
             font=dict(color="#0f172a")
         )
-        st.plotly_chart(fig_map1, use_container_width=True)
+        show_chart(world_map(fig_map1, map_detail), "map1")
     
     with col2:
         st.markdown("### 💉 Vaccination Rates")
         fig_map2 = px.choropleth(
-            latest_global,
+            map_df,
+            geojson=geometry_url(map_detail),
+            featureidkey="id",
             locations="iso_code",
             color="vaccination_rate",
             hover_name="location",
@@ -563,7 +1316,7 @@ elif selected_tab == "🗺️ Geographic":
             ),
             font=dict(color="#0f172a")
         )
-        st.plotly_chart(fig_map2, use_container_width=True)
+        show_chart(world_map(fig_map2, map_detail), "map2")
     
     # Continent Comparison
     st.markdown("### 🌍 Continent-wise Analysis")
@@ -591,7 +1344,7 @@ elif selected_tab == "🗺️ Geographic":
             template=PLOTLY_TEMPLATE
         )
         fig_cont.update_layout(height=350, paper_bgcolor="rgba(0,0,0,0)", showlegend=False)
-        st.plotly_chart(fig_cont, use_container_width=True)
+        show_chart(fig_cont, "cont")
     
     with col4:
         fig_cont_vax = px.bar(
@@ -604,16 +1357,15 @@ elif selected_tab == "🗺️ Geographic":
             template=PLOTLY_TEMPLATE
         )
         fig_cont_vax.update_layout(height=350, paper_bgcolor="rgba(0,0,0,0)", showlegend=False)
-        st.plotly_chart(fig_cont_vax, use_container_width=True)
+        show_chart(fig_cont_vax, "cont_vax")
     
     # Scatter Geo
     st.markdown("### 📍 Geographic Scatter")
-    # Note: This requires latitude/longitude data which may not be in the dataset
-    # We'll create a simple bubble map instead
-    
+    # Bubbles sit on the label points bundled with the map geometry
     fig_bubble = px.scatter_geo(
-        latest_global.assign(total_cases=latest_global['total_cases'].fillna(0)),
-        locations="iso_code",
+        map_df.assign(total_cases=map_df['total_cases'].fillna(0)),
+        lat="lat",
+        lon="lon",
         size="total_cases",
         hover_name="location",
         color="continent",
@@ -626,7 +1378,7 @@ elif selected_tab == "🗺️ Geographic":
         paper_bgcolor="rgba(0,0,0,0)",
         geo=dict(bgcolor="rgba(0,0,0,0)", landcolor="#e2e8f0")
     )
-    st.plotly_chart(fig_bubble, use_container_width=True)
+    show_chart(world_map(fig_bubble, map_detail), "bubble")
 
 # =============================================================================
 # VIEW 4: DEEP DIVE ANALYSIS
@@ -657,7 +1409,7 @@ elif selected_tab == "🔬 Analysis":
             paper_bgcolor="rgba(0,0,0,0)",
             plot_bgcolor="rgba(0,0,0,0)"
         )
-        st.plotly_chart(fig_scatter1, use_container_width=True)
+        show_chart(fig_scatter1, "scatter1")
     
     with col2:
         st.markdown("### 📊 HDI vs Mortality Rate")
@@ -676,7 +1428,7 @@ elif selected_tab == "🔬 Analysis":
             paper_bgcolor="rgba(0,0,0,0)",
             plot_bgcolor="rgba(0,0,0,0)"
         )
-        st.plotly_chart(fig_scatter2, use_container_width=True)
+        show_chart(fig_scatter2, "scatter2")
     
     # Correlation Heatmap
     st.markdown("### 🔥 Correlation Matrix")
@@ -711,7 +1463,7 @@ elif selected_tab == "🔬 Analysis":
             )
         )
         fig_corr.update_traces(textfont=dict(size=11, color="#000000"))
-        st.plotly_chart(fig_corr, use_container_width=True)
+        show_chart(fig_corr, "corr")
     else:
         st.warning("Insufficient data for correlation analysis with current filters.")
     
@@ -719,12 +1471,7 @@ elif selected_tab == "🔬 Analysis":
     st.markdown("### 🌡️ Cases Heatmap - Top Countries Over Time")
     
     # Prepare data: monthly aggregation for readability
-    heatmap_countries = global_df.groupby('location')['total_cases'].max().nlargest(15).index.tolist()
-    heatmap_data = global_df[global_df['location'].isin(heatmap_countries)].copy()
-    heatmap_data['month'] = heatmap_data['date'].dt.to_period('M').astype(str)
-    
-    heatmap_pivot = heatmap_data.groupby(['location', 'month'])['new_cases'].sum().reset_index()
-    heatmap_matrix = heatmap_pivot.pivot(index='location', columns='month', values='new_cases').fillna(0)
+    heatmap_matrix = query_monthly_heatmap(*data_filter)
     
     # Select every 3rd month for cleaner display
     if len(heatmap_matrix.columns) > 20:
@@ -749,7 +1496,7 @@ elif selected_tab == "🔬 Analysis":
             tickfont=dict(color="#334155")
         )
     )
-    st.plotly_chart(fig_heatmap, use_container_width=True)
+    show_chart(fig_heatmap, "heatmap")
 
     
     # Additional Scatter Plots
@@ -768,7 +1515,7 @@ elif selected_tab == "🔬 Analysis":
             template=PLOTLY_TEMPLATE
         )
         fig_scatter3.update_layout(height=350, paper_bgcolor="rgba(0,0,0,0)")
-        st.plotly_chart(fig_scatter3, use_container_width=True)
+        show_chart(fig_scatter3, "scatter3")
     
     with col4:
         st.markdown("### 🏥 Hospital Beds vs Deaths per Million")
@@ -782,7 +1529,7 @@ elif selected_tab == "🔬 Analysis":
             template=PLOTLY_TEMPLATE
         )
         fig_scatter4.update_layout(height=350, paper_bgcolor="rgba(0,0,0,0)")
-        st.plotly_chart(fig_scatter4, use_container_width=True)
+        show_chart(fig_scatter4, "scatter4")
 
 # =============================================================================
 # VIEW 5: STATISTICAL ANALYSIS
@@ -805,7 +1552,7 @@ elif selected_tab == "📉 Statistical":
             color_discrete_sequence=[COLORS["cases"]]
         )
         fig_hist1.update_layout(height=300, paper_bgcolor="rgba(0,0,0,0)")
-        st.plotly_chart(fig_hist1, use_container_width=True)
+        show_chart(fig_hist1, "hist1")
     
     with col2:
         st.markdown("### 💀 Mortality Rate Distribution")
@@ -818,7 +1565,7 @@ elif selected_tab == "📉 Statistical":
             color_discrete_sequence=[COLORS["danger"]]
         )
         fig_hist2.update_layout(height=300, paper_bgcolor="rgba(0,0,0,0)")
-        st.plotly_chart(fig_hist2, use_container_width=True)
+        show_chart(fig_hist2, "hist2")
     
     # Box Plots
     col3, col4 = st.columns(2)
@@ -834,7 +1581,7 @@ elif selected_tab == "📉 Statistical":
             color_discrete_sequence=px.colors.qualitative.Bold
         )
         fig_box1.update_layout(height=350, paper_bgcolor="rgba(0,0,0,0)", showlegend=False)
-        st.plotly_chart(fig_box1, use_container_width=True)
+        show_chart(fig_box1, "box1")
     
     with col4:
         st.markdown("### 🎻 Vaccination Rate Distribution")
@@ -848,7 +1595,7 @@ elif selected_tab == "📉 Statistical":
             color_discrete_sequence=px.colors.qualitative.Vivid
         )
         fig_violin.update_layout(height=350, paper_bgcolor="rgba(0,0,0,0)", showlegend=False)
-        st.plotly_chart(fig_violin, use_container_width=True)
+        show_chart(fig_violin, "violin")
     
     # Summary Statistics
     st.markdown("### 📋 Summary Statistics")
@@ -882,7 +1629,7 @@ elif selected_tab == "ℹ️ About":
     1. **Data Cleaning**
        - Removal of aggregate entities (World, income groups, etc.)
        - Missing value imputation using forward-fill, interpolation, and median strategies
-       - Outlier detection and handling
+       - Outlier detection: reporting spikes and negative corrections flagged with rolling robust z-scores (median / MAD)
        - Data type conversions
     
     2. **Feature Engineering**
@@ -934,6 +1681,61 @@ elif selected_tab == "ℹ️ About":
     st.markdown("---")
     st.markdown("**Last Updated**: December 2024")
 
+record_selection((start_date, end_date, selected_continent, requested_metric))
+
+# =============================================================================
+# EXPORT
+# =============================================================================
+with st.sidebar:
+    st.markdown("---")
+    st.markdown("### 📥 Export")
+    filter_key = (str(start_date.date()), str(end_date.date()), selected_continent)
+    slug = f"covid_{filter_key[0]}_{filter_key[1]}_{selected_continent.replace(' ', '_').lower()}"
+
+    data_format = st.selectbox("Data Format", list(EXPORT_FORMATS.keys()), key="export_data_format")
+    extension, mime = EXPORT_FORMATS[data_format]
+    if st.button("Prepare Data Export", key="prepare_data_export"):
+        st.session_state["data_export"] = (filter_key, data_format)
+    if st.session_state.get("data_export") == (filter_key, data_format):
+        with st.spinner("Writing filtered data..."):
+            payload = export_filtered_data(data_version, start_date, end_date, selected_continent, data_format)
+        st.download_button(
+            f"⬇️ Download {data_format}",
+            data=payload,
+            file_name=f"{slug}.{extension}",
+            mime=mime,
+            key="download_data"
+        )
+
+    if tab_figures and find_chrome() is None:
+        st.info("ℹ️ Chart export needs `kaleido` and Chrome. Install Chrome, or run `plotly_get_chrome` "
+                "after `pip install -r requirements.txt`, then restart the dashboard.")
+    elif tab_figures:
+        image_label = st.selectbox("Chart Format", list(IMAGE_FORMATS.keys()), key="export_image_format")
+        image_format = IMAGE_FORMATS[image_label]
+        chart_key = filter_key + (anomaly_mode, show_per_capita, selected_tab, tuple(selected_countries))
+        if st.button("Render Current Charts", key="render_charts"):
+            st.session_state["chart_export"] = (submit_figure_export(chart_key, tab_figures, image_format), image_format, chart_key)
+
+        # An archive rendered for another filter, tab or format is not offered
+        chart_export = st.session_state.get("chart_export")
+        if chart_export and chart_export[1:] != (image_format, chart_key):
+            chart_export = None
+        job = get_export_jobs().get(chart_export[0]) if chart_export else None
+        if job is not None and not job.done():
+            st.info("⏳ Rendering charts in the background...")
+            st.button("Check Again", key="refresh_chart_export")
+        elif job is not None and job.exception() is not None:
+            st.error(f"❌ Chart export failed: {job.exception()}", icon="🚨")
+        elif job is not None:
+            st.download_button(
+                f"⬇️ Download Charts ({chart_export[1].upper()})",
+                data=job.result(),
+                file_name=f"{slug}_charts_{chart_export[1]}.zip",
+                mime="application/zip",
+                key="download_charts"
+            )
+
 # Footer
 st.markdown("<br><br>", unsafe_allow_html=True)
 st.markdown("---")
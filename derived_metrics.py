@@ -0,0 +1,84 @@
+"""Derived metrics for the COVID-19 dashboard.
+
+Ratios and differences of base columns are not stored in the cleaned dataset.
+Each one is registered here as an expression over base columns and evaluated on
+demand, only for the rows (or date x location grids) a view asks for:
+
+    evaluate({'people_vaccinated': pv, 'population': pop}, ['vaccination_rate'])
+    with_derived(latest_rows, ['vaccination_rate', 'mortality_rate'])
+
+All requested metrics are computed in one pass into a single preallocated block.
+Divisions are masked with ``where=`` so a zero denominator leaves NaN directly,
+instead of producing inf and replacing it in a second copy.
+"""
+import numpy as np
+
+# name -> (operation, (left, right), scale)
+#   ratio:      left / right * scale, NaN where right is 0
+#   difference: max(left - right, 0) * scale
+DERIVED_METRICS = {
+    'vaccination_rate': ('ratio', ('people_vaccinated', 'population'), 100),
+    'fully_vaccinated_rate': ('ratio', ('people_fully_vaccinated', 'population'), 100),
+    'mortality_rate': ('ratio', ('total_deaths', 'total_cases'), 100),
+    'active_cases': ('difference', ('total_cases', 'total_deaths'), 1),
+    'cases_per_population': ('ratio', ('total_cases', 'population'), 100),
+    'deaths_per_population': ('ratio', ('total_deaths', 'population'), 100),
+}
+
+
+def per_million_name(metric):
+    """Name of the per-million variant of a base metric.
+
+    Prefixed rather than suffixed: the dataset already stores some ``*_per_million``
+    columns (unadjusted for anomalies), and derived names must never shadow them.
+    """
+    return f'per_million_{metric}'
+
+
+# Per-million variant of every count metric shown on the Trends tab
+PER_CAPITA_METRICS = ['new_cases_smoothed', 'new_deaths_smoothed', 'total_cases', 'total_deaths']
+for _metric in PER_CAPITA_METRICS:
+    DERIVED_METRICS[per_million_name(_metric)] = ('ratio', (_metric, 'population'), 1_000_000)
+
+
+def base_columns(names):
+    """Base columns needed to evaluate the given derived metrics, in first-use order."""
+    return list(dict.fromkeys(col for name in names for col in DERIVED_METRICS[name][1]))
+
+
+def evaluate(columns, names):
+    """Evaluate derived metrics over equally shaped base arrays; returns name -> array."""
+    names = list(dict.fromkeys(names))
+    arrays = {col: np.asarray(columns[col], dtype=float) for col in base_columns(names)}
+    if not names:
+        return {}
+    shape = next(iter(arrays.values())).shape
+    block = np.full((len(names),) + shape, np.nan)
+    nonzero = {}  # denominator masks, shared by the ratios that use the same column
+
+    for out, name in zip(block, names):
+        operation, (left, right), scale = DERIVED_METRICS[name]
+        if operation == 'ratio':
+            if right not in nonzero:
+                nonzero[right] = arrays[right] != 0
+            np.divide(arrays[left], arrays[right], out=out, where=nonzero[right])
+        else:
+            np.subtract(arrays[left], arrays[right], out=out)
+            np.maximum(out, 0, out=out)
+        if scale != 1:
+            out *= scale
+    return dict(zip(names, block))
+
+
+def with_derived(frame, names):
+    """Add derived metric columns to a DataFrame in place and return it.
+
+    Raises ValueError if a derived name is already a column of the frame.
+    """
+    existing = [name for name in names if name in frame.columns]
+    if existing:
+        raise ValueError(f"Derived metrics would overwrite existing columns: {', '.join(existing)}")
+    values = evaluate({col: frame[col].to_numpy(dtype=float) for col in base_columns(names)}, names)
+    for name, array in values.items():
+        frame[name] = array
+    return frame
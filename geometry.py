@@ -0,0 +1,262 @@
+"""Build the bundled world geometry used by the dashboard maps.
+
+Reads a country-level GeoJSON (Natural Earth admin-0 countries) and writes one
+simplified, ISO3-keyed GeoJSON per detail level into ``static/``, plus a small
+index of the levels. Streamlit serves ``static/`` from the app itself
+(``server.enableStaticServing``), so maps need no CDN: the browser fetches each
+file once and every map figure references it by URL.
+
+Each feature's ``id`` is its ISO 3166-1 alpha-3 code, the same key as the
+dataset's ``iso_code``, and its properties carry a label point (``lat``/``lon``)
+for bubble maps.
+
+Coarse sources leave out small states (Singapore, Malta, Bahrain, ...). A level
+can be built from a finer source (``--level-source high=ne_10m...``), and
+``--points`` adds label points (a GeoJSON of Point features, e.g. Natural Earth
+admin-0 label points) for countries without an outline at some level; they are
+written to ``world-points.json`` so bubble maps can still place them.
+
+Plotly's geo plots also fetch a base-layer TopoJSON (``world_110m.json``) from
+``topojsonURL`` whenever a trace has a ``locationmode``, which every GeoJSON
+choropleth does; the coarsest level is written in that format too, so the app
+points ``topojsonURL`` at ``static/`` instead of Plotly's CDN.
+
+Usage:
+    python geometry.py --source ne_110m_admin_0_countries.geojson
+    python geometry.py --source ne_110m_admin_0_countries.geojson \
+        --level-source high=ne_50m_admin_0_countries.geojson --points label_points.geojson
+    python geometry.py --source countries.geojson --level low=0.5 --level high=0
+"""
+import argparse
+import json
+import math
+import os
+
+import numpy as np
+
+OUTPUT_DIR = 'static'
+INDEX_FILE = 'world-levels.json'
+POINTS_FILE = 'world-points.json'
+# Name plotly.js requests for the default world scope and resolution
+TOPOJSON_FILE = 'world_110m.json'
+# Douglas-Peucker tolerance in degrees; 0 keeps every vertex
+LEVELS = {'low': 0.4, 'medium': 0.1, 'high': 0.0}
+
+
+def feature_iso(properties):
+    # Natural Earth leaves ISO_A3 as -99 for a few countries (France, Norway); fall back to the admin code
+    props = {key.upper(): value for key, value in properties.items()}
+    for key in ('ISO_A3', 'ISO_A3_EH', 'ADM0_A3'):
+        code = props.get(key)
+        if code and code != '-99':
+            return code
+    return None
+
+
+def simplify_line(points, tolerance):
+    # Iterative Douglas-Peucker on an (n, 2) array; the endpoints are always kept
+    if tolerance <= 0 or len(points) < 3:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        segment = end - start
+        inner = points[first + 1:last] - start
+        length = np.hypot(*segment)
+        if length == 0:
+            distance = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            distance = np.abs(segment[0] * inner[:, 1] - segment[1] * inner[:, 0]) / length
+        index = int(distance.argmax())
+        if distance[index] > tolerance:
+            split = first + 1 + index
+            keep[split] = True
+            stack.extend([(first, split), (split, last)])
+    return points[keep]
+
+
+def simplify_ring(ring, tolerance, precision):
+    points = np.round(simplify_line(np.asarray(ring, dtype=float), tolerance), precision)
+    # Rounding can collapse neighbouring vertices
+    points = points[np.r_[True, np.any(np.diff(points, axis=0) != 0, axis=1)]]
+    if len(points) < 4:
+        return None
+    return points.tolist()
+
+
+def ring_area_centroid(ring):
+    x, y = np.asarray(ring, dtype=float).T
+    cross = x[:-1] * y[1:] - x[1:] * y[:-1]
+    area = cross.sum() / 2
+    if area == 0:
+        return 0.0, x.mean(), y.mean()
+    return abs(area), (x[:-1] + x[1:]) @ cross / (6 * area), (y[:-1] + y[1:]) @ cross / (6 * area)
+
+
+def simplify_feature(geometry, tolerance, precision):
+    polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+    simplified = []
+    for polygon in polygons:
+        outer = simplify_ring(polygon[0], tolerance, precision)
+        if outer is None:
+            continue
+        holes = [ring for ring in (simplify_ring(hole, tolerance, precision) for hole in polygon[1:]) if ring]
+        simplified.append([outer] + holes)
+    if not simplified:
+        # Small islands vanish at coarse levels; keep the country's largest polygon at full detail
+        largest = max(polygons, key=lambda polygon: ring_area_centroid(polygon[0])[0])
+        simplified = [[np.round(np.asarray(largest[0], dtype=float), precision).tolist()]]
+
+    # Label point: centroid of the largest polygon
+    _, lon, lat = max(ring_area_centroid(polygon[0]) for polygon in polygons)
+    if len(simplified) == 1:
+        return {'type': 'Polygon', 'coordinates': simplified[0]}, lat, lon
+    return {'type': 'MultiPolygon', 'coordinates': simplified}, lat, lon
+
+
+def build_level(source, tolerance):
+    precision = 3 if tolerance <= 0 else max(1, math.ceil(-math.log10(tolerance)) + 1)
+    features = []
+    for feature in source['features']:
+        iso = feature_iso(feature['properties'])
+        if iso is None or not feature.get('geometry'):
+            continue
+        geometry, lat, lon = simplify_feature(feature['geometry'], tolerance, precision)
+        name = feature['properties'].get('name') or feature['properties'].get('NAME')
+        features.append({
+            'type': 'Feature',
+            'id': iso,
+            'properties': {'name': name, 'lat': round(lat, 2), 'lon': round(lon, 2)},
+            'geometry': geometry
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def build_points(source, outlined):
+    # Label points for countries without an outline at some level
+    points = {}
+    for feature in source['features']:
+        iso = feature_iso(feature['properties'])
+        geometry = feature.get('geometry') or {}
+        if iso and iso not in outlined and geometry.get('type') == 'Point':
+            lon, lat = geometry['coordinates'][:2]
+            name = feature['properties'].get('name') or feature['properties'].get('NAME')
+            points[iso] = {'name': name, 'lat': round(lat, 2), 'lon': round(lon, 2)}
+    return dict(sorted(points.items()))
+
+
+def build_topojson(collection):
+    # Unquantized TopoJSON, one arc per ring; objects named like Plotly's own files
+    arcs, countries, land, coastlines = [], [], [], []
+    for feature in collection['features']:
+        geometry = feature['geometry']
+        polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+        indexed = []
+        for polygon in polygons:
+            rings = []
+            for ring in polygon:
+                rings.append([len(arcs)])
+                coastlines.append([len(arcs)])
+                arcs.append(ring)
+            indexed.append(rings)
+        shape = {'type': 'MultiPolygon', 'arcs': indexed} if len(indexed) > 1 else {'type': 'Polygon', 'arcs': indexed[0]}
+        countries.append(dict(shape, id=feature['id'], properties={'name': feature['properties']['name']}))
+        land.append(shape)
+
+    def collection_of(geometries):
+        return {'type': 'GeometryCollection', 'geometries': geometries}
+
+    return {
+        'type': 'Topology',
+        'objects': {
+            'countries': collection_of(countries),
+            'land': collection_of(land),
+            'coastlines': collection_of([{'type': 'MultiLineString', 'arcs': coastlines}]),
+            'ocean': collection_of([]),
+            'lakes': collection_of([]),
+            'rivers': collection_of([]),
+            'subunits': collection_of([]),
+        },
+        'arcs': arcs
+    }
+
+
+def build(source_path, levels=LEVELS, output_dir=OUTPUT_DIR, level_sources=None, points_path=None):
+    level_sources = level_sources or {}
+    sources = {}
+    for path in {source_path, *level_sources.values()}:
+        with open(path) as handle:
+            sources[path] = json.load(handle)
+    os.makedirs(output_dir, exist_ok=True)
+
+    index, drawn = {}, []
+    for position, (name, tolerance) in enumerate(sorted(levels.items(), key=lambda item: -item[1])):
+        level_source = level_sources.get(name, source_path)
+        collection = build_level(sources[level_source], tolerance)
+        if position == 0:
+            with open(os.path.join(output_dir, TOPOJSON_FILE), 'w') as handle:
+                json.dump(build_topojson(collection), handle, separators=(',', ':'))
+            print(f'[plotly  ] {TOPOJSON_FILE:24} {len(collection["features"]):>4} countries  base layers for plotly.js')
+        drawn.append({feature['id'] for feature in collection['features']})
+        file_name = f'world-{name}.geojson'
+        with open(os.path.join(output_dir, file_name), 'w') as handle:
+            json.dump(collection, handle, separators=(',', ':'))
+        size = os.path.getsize(os.path.join(output_dir, file_name))
+        index[name] = {'file': file_name, 'source': os.path.basename(level_source), 'tolerance': tolerance,
+                       'features': len(collection['features']), 'bytes': size}
+        print(f'[{name:8}] {file_name:24} {len(collection["features"]):>4} countries  {size / 1024:8.1f} KB')
+
+    if points_path:
+        with open(points_path) as handle:
+            points = build_points(json.load(handle), set.intersection(*drawn))
+        with open(os.path.join(output_dir, POINTS_FILE), 'w') as handle:
+            json.dump(points, handle, indent=1)
+        print(f'[points  ] {POINTS_FILE:24} {len(points):>4} countries without an outline at some level')
+
+    # Coarsest level first
+    with open(os.path.join(output_dir, INDEX_FILE), 'w') as handle:
+        json.dump(index, handle, indent=1)
+    return index
+
+
+def parse_level(value):
+    name, _, tolerance = value.partition('=')
+    try:
+        return name, float(tolerance)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected NAME=TOLERANCE, got {value!r}')
+
+
+def parse_level_source(value):
+    name, _, path = value.partition('=')
+    if not name or not path:
+        raise argparse.ArgumentTypeError(f'expected NAME=PATH, got {value!r}')
+    return name, path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the simplified world geometry for the dashboard maps.')
+    parser.add_argument('--source', required=True, help='country-level GeoJSON (e.g. Natural Earth admin-0)')
+    parser.add_argument('--output-dir', default=OUTPUT_DIR, help='directory served as static files (default: %(default)s)')
+    parser.add_argument('--level', action='append', type=parse_level, metavar='NAME=TOLERANCE',
+                        help='detail level and its tolerance in degrees; repeatable (default: %s)'
+                        % ', '.join(f'{name}={tolerance}' for name, tolerance in LEVELS.items()))
+    parser.add_argument('--level-source', action='append', type=parse_level_source, metavar='NAME=PATH',
+                        help='finer GeoJSON for one level (e.g. high=ne_50m_admin_0_countries.geojson); repeatable')
+    parser.add_argument('--points', help='GeoJSON of label points for countries without an outline')
+    args = parser.parse_args()
+    levels = dict(args.level) if args.level else LEVELS
+    level_sources = dict(args.level_source or [])
+    unknown = set(level_sources) - set(levels)
+    if unknown:
+        parser.error(f'--level-source for unknown level(s): {", ".join(sorted(unknown))}')
+    build(args.source, levels, args.output_dir, level_sources, args.points)
+
+
+if __name__ == '__main__':
+    main()
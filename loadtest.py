@@ -0,0 +1,412 @@
+"""Offline load test for the dashboard.
+
+Drives N simulated sessions of app.py in one process, the way one Streamlit
+replica serves them. All sessions share the process and its caches. Each
+session follows an interaction script: change the date range, switch
+continent, switch tabs, pick a map metric. Every action triggers a rerun, and
+the rerun is timed.
+
+For each session count the report gives:
+- rerun latency percentiles (p50 / p95 / p99);
+- throughput (reruns per second, across all sessions);
+- resident memory of the process;
+- errors: uncaught exceptions plus st.error messages shown by the app.
+
+The data is a synthetic OWID-shaped raw dataset: every country in the bundled
+map geometry, epidemic waves, vaccination uptake, reporting artefacts and OWID
+aggregate rows. It goes through the real preprocessing pipeline, so no
+network or real data is needed.
+
+Usage:
+    python loadtest.py                          # 1, 2, 4, 8 sessions
+    python loadtest.py --sessions 1 8 32 --steps 20
+    python loadtest.py --store --json report.json
+    python loadtest.py --cold                   # clear caches before each level
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+import streamlit_option_menu
+from streamlit.logger import set_log_level
+from streamlit.testing.v1 import AppTest, local_script_runner
+
+import pipeline
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(APP_DIR, 'app.py')
+WORK_DIR = '.loadtest'
+SESSION_LEVELS = [1, 2, 4, 8]
+STEPS = 12
+DAYS = 1200
+RERUN_TIMEOUT = 300
+TAB_KEY = 'loadtest_tab'
+
+
+# =============================================================================
+# SYNTHETIC DATASET
+# =============================================================================
+def geometry_countries():
+    # Real ISO3 codes and names from the bundled geometry, so the maps have something to draw
+    with open(os.path.join(APP_DIR, 'static', 'world-levels.json')) as handle:
+        levels = json.load(handle)
+    with open(os.path.join(APP_DIR, 'static', next(iter(levels.values()))['file'])) as handle:
+        features = json.load(handle)['features']
+    countries = pd.DataFrame({
+        'iso_code': [feature['id'] for feature in features],
+        'location': [feature['properties']['name'] for feature in features],
+        'lat': [feature['properties']['lat'] for feature in features],
+        'lon': [feature['properties']['lon'] for feature in features]
+    })
+    countries = countries[countries['iso_code'] != 'ATA']
+    # Rough continent boxes; close enough for a synthetic dataset
+    lat, lon = countries['lat'], countries['lon']
+    countries['continent'] = np.select(
+        [(lon < -30) & (lat > 12), lon < -30, (lon > 110) & (lat < -10), (lon < 60) & (lat > 35), lon < 60],
+        ['North America', 'South America', 'Oceania', 'Europe', 'Africa'],
+        default='Asia'
+    )
+    return countries.drop(columns=['lat', 'lon']).reset_index(drop=True)
+
+
+def rolling_mean(values, window=7):
+    # Trailing mean along the day axis (country x day), ignoring missing days
+    filled = np.nan_to_num(values)
+    counts = np.cumsum(~np.isnan(values), axis=1)
+    sums = np.cumsum(filled, axis=1)
+    sums[:, window:] -= sums[:, :-window].copy()
+    counts[:, window:] -= counts[:, :-window].copy()
+    return np.divide(sums, counts, out=np.full(values.shape, np.nan), where=counts > 0)
+
+
+def synthesize(path, days=DAYS, countries=None, seed=0):
+    rng = np.random.default_rng(seed)
+    meta = geometry_countries()
+    if countries is not None and countries < len(meta):
+        meta = meta.iloc[np.sort(rng.choice(len(meta), countries, replace=False))].reset_index(drop=True)
+    n = len(meta)
+    dates = pd.date_range('2020-01-22', periods=days, freq='D')
+    t = np.arange(days, dtype=float)
+    population = np.round(rng.lognormal(16, 1.6, n).clip(5e4, 1.4e9))
+
+    # Epidemic waves: Gaussian bumps with per-country timing, width and height
+    centers = rng.uniform(60, days, (n, 4))
+    widths = rng.uniform(15, 60, (n, 4))
+    heights = rng.uniform(5e-5, 2e-3, (n, 4))
+    rate = (heights[:, :, None] * np.exp(-((t - centers[:, :, None]) ** 2) / (2 * widths[:, :, None] ** 2))).sum(axis=1)
+    new_cases = rng.poisson(rate * population[:, None]).astype(float)
+    new_deaths = rng.binomial(new_cases.astype(np.int64), rng.uniform(0.003, 0.03, n)[:, None]).astype(float)
+
+    # Reporting artefacts: weekly reporters, gaps, backlog spikes and negative corrections
+    weekly = rng.random(n) < 0.2
+    weekly_totals = np.add.reduceat(new_cases[weekly], np.arange(0, days, 7), axis=1)
+    new_cases[weekly] = 0.0
+    new_cases[np.ix_(weekly, np.arange(0, days, 7))] = weekly_totals
+    new_cases[rng.random((n, days)) < 0.03] = np.nan
+    spikes = rng.random(n) < 0.3
+    new_cases[spikes, rng.integers(100, days, spikes.sum())] *= 30
+    corrections = rng.random(n) < 0.15
+    new_cases[corrections, rng.integers(100, days, corrections.sum())] = -rng.uniform(100, 5000, corrections.sum())
+
+    total_cases = np.cumsum(np.nan_to_num(new_cases).clip(min=0), axis=1)
+    total_deaths = np.cumsum(new_deaths, axis=1)
+    total_cases[rng.random((n, days)) < 0.1] = np.nan
+
+    # Vaccination: logistic uptake from a per-country start date
+    start = rng.uniform(320, 450, n)[:, None]
+    coverage = rng.uniform(0.2, 0.95, n)[:, None]
+    uptake = coverage / (1 + np.exp(-(t - start - 90) / 35))
+    people_vaccinated = np.where(t >= start, np.round(uptake * population[:, None]), np.nan)
+    people_fully_vaccinated = np.round(people_vaccinated * 0.85)
+    total_vaccinations = np.round(people_vaccinated * 2.1)
+    new_vaccinations = np.diff(total_vaccinations, axis=1, prepend=np.nan)
+
+    stringency = np.clip(50 + np.cumsum(rng.normal(0, 2, (n, days)), axis=1), 0, 100)
+    reproduction = 1 + 0.3 * np.sin(t / 45 + rng.uniform(0, 6, n)[:, None]) + rng.normal(0, 0.05, (n, days))
+
+    def per_country(values):
+        return np.repeat(values, days)
+
+    per_million = 1e6 / population[:, None]
+    raw = pd.DataFrame({
+        'iso_code': per_country(meta['iso_code'].to_numpy()),
+        'continent': per_country(meta['continent'].to_numpy()),
+        'location': per_country(meta['location'].to_numpy()),
+        'date': np.tile(dates, n),
+        'total_cases': total_cases.ravel(),
+        'new_cases': new_cases.ravel(),
+        'new_cases_smoothed': rolling_mean(new_cases).ravel(),
+        'total_deaths': total_deaths.ravel(),
+        'new_deaths': new_deaths.ravel(),
+        'new_deaths_smoothed': rolling_mean(new_deaths).ravel(),
+        'total_cases_per_million': (total_cases * per_million).ravel(),
+        'new_cases_per_million': (new_cases * per_million).ravel(),
+        'total_deaths_per_million': (total_deaths * per_million).ravel(),
+        'new_deaths_per_million': (new_deaths * per_million).ravel(),
+        'reproduction_rate': reproduction.ravel(),
+        'total_vaccinations': total_vaccinations.ravel(),
+        'people_vaccinated': people_vaccinated.ravel(),
+        'people_fully_vaccinated': people_fully_vaccinated.ravel(),
+        'new_vaccinations': new_vaccinations.ravel(),
+        'new_vaccinations_smoothed': rolling_mean(new_vaccinations).ravel(),
+        'stringency_index': stringency.ravel(),
+        'population': per_country(population),
+        'population_density': per_country(rng.lognormal(4, 1.2, n)),
+        'median_age': per_country(rng.uniform(16, 48, n)),
+        'gdp_per_capita': per_country(rng.lognormal(9, 1.1, n)),
+        'hospital_beds_per_thousand': per_country(rng.uniform(0.5, 12, n)),
+        'life_expectancy': per_country(rng.uniform(55, 85, n)),
+        'human_development_index': per_country(rng.uniform(0.4, 0.95, n))
+    })
+
+    # OWID aggregate rows (World, continents), which preprocessing removes
+    aggregates = raw.groupby(['continent', 'date'], as_index=False)[['new_cases', 'total_cases', 'population']].sum()
+    aggregates['location'] = aggregates['continent']
+    aggregates['iso_code'] = 'OWID_' + aggregates['continent'].str[:3].str.upper()
+    world = raw.groupby('date', as_index=False)[['new_cases', 'total_cases', 'population']].sum()
+    world['location'], world['iso_code'] = 'World', 'OWID_WRL'
+    aggregates['continent'] = world['continent'] = np.nan
+    raw = pd.concat([raw, aggregates, world], ignore_index=True)
+
+    raw.to_csv(path, index=False, date_format='%Y-%m-%d')
+    return raw
+
+
+def prepare_workdir(work_dir, days, countries, store, regenerate):
+    os.makedirs(work_dir, exist_ok=True)
+    raw_path = os.path.join(work_dir, pipeline.RAW_PATH)
+    if regenerate or not os.path.exists(raw_path):
+        started = time.perf_counter()
+        raw = synthesize(raw_path, days, countries)
+        print(f'[data] synthetic {raw_path}  {raw.shape}  {time.perf_counter() - started:.2f}s')
+    pipeline.run(
+        raw_path,
+        os.path.join(work_dir, pipeline.OUTPUT_PATH),
+        os.path.join(work_dir, pipeline.CACHE_DIR),
+        force=regenerate,
+        store_path=os.path.join(work_dir, 'covid_store') if store else None
+    )
+    if not store:
+        shutil.rmtree(os.path.join(work_dir, 'covid_store'), ignore_errors=True)
+
+    # app.py resolves data and map geometry relative to the working directory
+    static = os.path.join(work_dir, 'static')
+    if not os.path.exists(static):
+        os.symlink(os.path.join(APP_DIR, 'static'), static)
+
+
+# =============================================================================
+# SESSIONS
+# =============================================================================
+menu_options = []
+
+
+def scripted_option_menu(menu_title, options, default_index=0, **kwargs):
+    # The navigation bar is a browser component; sessions pick their tab through session state
+    if not menu_options:
+        menu_options.extend(options)
+    return st.session_state.get(TAB_KEY, options[default_index])
+
+
+def share_script_cache():
+    # A server compiles app.py once for all sessions; AppTest would recompile it on every rerun.
+    # This replaces private Streamlit names (written against 1.66), so stop if they have moved
+    # rather than measure concurrent recompiles.
+    try:
+        from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    except ImportError as exc:
+        raise RuntimeError(f'streamlit {st.__version__} has no script_cache.ScriptCache; '
+                           'the load test cannot share compiled scripts between sessions') from exc
+    if not hasattr(local_script_runner, 'ScriptCache') or not hasattr(ScriptCache, 'get_bytecode'):
+        raise RuntimeError(f'streamlit {st.__version__}: AppTest no longer creates a ScriptCache per run; '
+                           'update share_script_cache() for this version')
+    shared = ScriptCache()
+    local_script_runner.ScriptCache = lambda: shared
+
+
+def widget_by_label(widgets, label):
+    return next(widget for widget in widgets if widget.label == label)
+
+
+def pick(rng, options):
+    return options[int(rng.integers(len(options)))]
+
+
+def switch_tab(at, rng, bounds):
+    at.session_state[TAB_KEY] = pick(rng, menu_options)
+
+
+def change_date_range(at, rng, bounds):
+    first, last = bounds
+    span = int(rng.integers(30, 400))
+    end = last - pd.Timedelta(days=int(rng.integers(0, max(1, (last - first).days - span))))
+    at.date_input(key='date_range').set_value((max(first, end - pd.Timedelta(days=span)).date(), end.date()))
+
+
+def switch_continent(at, rng, bounds):
+    widget = widget_by_label(at.selectbox, 'Continent')
+    widget.select(pick(rng, widget.options))
+
+
+def pick_map_metric(at, rng, bounds):
+    widget = at.selectbox(key='map_metric')
+    widget.select(pick(rng, widget.options))
+
+
+ACTIONS = {
+    'switch_tab': switch_tab,
+    'change_date_range': change_date_range,
+    'switch_continent': switch_continent,
+    'pick_map_metric': pick_map_metric,
+}
+
+# Interaction scripts, cycled by each session; sessions are assigned scripts round-robin
+SCRIPTS = {
+    'browse': ['switch_tab', 'switch_tab', 'pick_map_metric', 'pick_map_metric', 'switch_tab'],
+    'explore_dates': ['change_date_range', 'pick_map_metric', 'change_date_range', 'switch_tab'],
+    'regional': ['switch_continent', 'switch_tab', 'change_date_range', 'switch_continent', 'pick_map_metric'],
+}
+
+
+def run_session(session_id, steps, bounds, seed):
+    rng = np.random.default_rng(seed + session_id)
+    script = list(SCRIPTS.values())[session_id % len(SCRIPTS)]
+    at = AppTest.from_file(APP_PATH, default_timeout=RERUN_TIMEOUT)
+    samples, errors = [], 0
+
+    def failed(action, exc):
+        # AppTest itself failing (e.g. on a widget it cannot drive) costs one rerun, not the level
+        nonlocal errors
+        errors += 1
+        print(f'[session {session_id}] {action}: {type(exc).__name__}: {exc}', file=sys.stderr)
+
+    def rerun(action):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            at.run()
+        except Exception as exc:
+            failed(action, exc)
+            return
+        samples.append((action, time.perf_counter() - started))
+        # Uncaught exceptions and the app's own st.error messages
+        errors += len(at.exception) + len(at.error)
+
+    rerun('open')
+    at.session_state[TAB_KEY] = menu_options[0]
+    for step in range(steps):
+        action = script[step % len(script)]
+        if action == 'pick_map_metric' and at.session_state[TAB_KEY] != menu_options[0]:
+            # The map metric lives on the Overview tab; opening it is a rerun of its own
+            at.session_state[TAB_KEY] = menu_options[0]
+            rerun('switch_tab')
+        try:
+            ACTIONS[action](at, rng, bounds)
+        except Exception as exc:
+            failed(action, exc)
+            continue
+        rerun(action)
+    return samples, errors
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as handle:
+            return int(handle.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (FileNotFoundError, ValueError, OSError):
+        return float('nan')
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def run_level(sessions, steps, bounds, seed):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions, thread_name_prefix='session') as pool:
+        results = list(pool.map(lambda i: run_session(i, steps, bounds, seed), range(sessions)))
+    elapsed = time.perf_counter() - started
+
+    samples = [sample for session_samples, _ in results for sample in session_samples]
+    latencies = np.array([seconds for _, seconds in samples]) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (float('nan'),) * 3
+    by_action = {
+        action: float(np.percentile([seconds * 1000 for name, seconds in samples if name == action], 95))
+        for action in dict.fromkeys(name for name, _ in samples)
+    }
+    return {
+        'sessions': sessions,
+        'reruns': len(samples),
+        'errors': sum(errors for _, errors in results),
+        'p50_ms': float(p50),
+        'p95_ms': float(p95),
+        'p99_ms': float(p99),
+        'throughput': len(samples) / elapsed,
+        'rss_mb': rss_mb(),
+        'peak_rss_mb': peak_rss_mb(),
+        'p95_by_action_ms': by_action
+    }
+
+
+# =============================================================================
+# RUNNER
+# =============================================================================
+def main():
+    parser = argparse.ArgumentParser(description='Offline multi-session load test for app.py.')
+    parser.add_argument('--sessions', type=int, nargs='+', default=SESSION_LEVELS, help='concurrent session counts (default: %(default)s)')
+    parser.add_argument('--steps', type=int, default=STEPS, help='interactions per session (default: %(default)s)')
+    parser.add_argument('--days', type=int, default=DAYS, help='days of synthetic data (default: %(default)s)')
+    parser.add_argument('--countries', type=int, help='number of synthetic countries (default: all in the map geometry)')
+    parser.add_argument('--store', action='store_true', help='serve the data from a partitioned store instead of the CSV')
+    parser.add_argument('--cold', action='store_true', help='clear Streamlit caches before each level')
+    parser.add_argument('--regenerate', action='store_true', help='rebuild the synthetic dataset')
+    parser.add_argument('--work-dir', default=WORK_DIR, help='dataset and cache directory (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar='PATH', help='also write the report as JSON')
+    args = parser.parse_args()
+
+    json_path = os.path.abspath(args.json) if args.json else None
+    prepare_workdir(args.work_dir, args.days, args.countries, args.store, args.regenerate)
+    os.chdir(args.work_dir)
+    streamlit_option_menu.option_menu = scripted_option_menu
+    share_script_cache()
+    set_log_level('error')
+    cleaned = pd.read_csv(pipeline.OUTPUT_PATH, usecols=['date'], parse_dates=['date'])['date']
+    bounds = (cleaned.min(), cleaned.max())
+
+    if not args.cold:
+        # One untimed session fills the shared caches, as after a replica's first visitor
+        print('[warmup] ', end='', flush=True)
+        run_session(0, 0, bounds, args.seed)
+        print(f'{rss_mb():.0f} MB')
+
+    print(f'{"sessions":>8} {"reruns":>7} {"errors":>6} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"reruns/s":>9} {"rss MB":>8}')
+    report = []
+    for sessions in args.sessions:
+        if args.cold:
+            st.cache_data.clear()
+            st.cache_resource.clear()
+        level = run_level(sessions, args.steps, bounds, args.seed)
+        report.append(level)
+        print(f'{level["sessions"]:>8} {level["reruns"]:>7} {level["errors"]:>6} {level["p50_ms"]:>8.0f} {level["p95_ms"]:>8.0f} '
+              f'{level["p99_ms"]:>8.0f} {level["throughput"]:>9.2f} {level["rss_mb"]:>8.0f}')
+
+    print(f'peak rss {report[-1]["peak_rss_mb"]:.0f} MB; p95 by action at {report[-1]["sessions"]} sessions: '
+          + ', '.join(f'{action} {ms:.0f} ms' for action, ms in report[-1]['p95_by_action_ms'].items()))
+    if json_path:
+        with open(json_path, 'w') as handle:
+            json.dump(report, handle, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+"""Headless preprocessing pipeline for the COVID-19 dashboard.
+
+Runs the preprocessing stages of project_notebook.ipynb without the plotting
+cells and writes the dataset the dashboard reads (cleaned_covid_data.csv). The
+notebook calls the stage functions below, so both produce the same data.
+Engineered features (vaccination_rate, mortality_rate, ...) are not stored; the
+dashboard evaluates them on demand from derived_metrics.py.
+
+Each stage's output is cached on disk under a key built from its input's key,
+the stage's own source code and the module constants it reads. A re-run after editing one stage therefore
+reloads the last unchanged stage from disk and only runs the stages after it.
+
+Usage:
+    python pipeline.py
+    python pipeline.py --input owid-covid-data.csv --output cleaned_covid_data.csv
+    python pipeline.py --force        # ignore cached stages
+    python pipeline.py --store covid_store   # also write the partitioned store the dashboard queries
+"""
+import argparse
+import glob
+import hashlib
+import inspect
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from query_engine import read_manifest, source_signature, write_store
+
+RAW_PATH = 'owid-covid-data.csv'
+OUTPUT_PATH = 'cleaned_covid_data.csv'
+CACHE_DIR = '.pipeline_cache'
+
+# Bit flags stored in the compact `anomaly_flags` column (uint8), with the smoothed
+# series the dashboard adjusts along with each flagged column
+ANOMALY_BITS = {
+    'new_cases': {'spike': 1, 'negative': 2, 'smoothed': 'new_cases_smoothed'},
+    'new_deaths': {'spike': 4, 'negative': 8, 'smoothed': 'new_deaths_smoothed'}
+}
+ANOMALY_WINDOW = 42       # centered rolling window (days)
+ANOMALY_MIN_PERIODS = 5   # reported days required in the window
+ANOMALY_THRESHOLD = 10.0  # robust z-score above which a day is a spike
+
+
+# =============================================================================
+# STAGES (one per notebook preprocessing step)
+# =============================================================================
+def ingest(path):
+    df = pd.read_csv(path)
+    df['date'] = pd.to_datetime(df['date'])
+    return df
+
+
+def remove_aggregates(df):
+    # Remove rows with OWID codes (aggregates like World, income groups)
+    df = df[~df['iso_code'].str.startswith('OWID', na=False)]
+    # Keep only rows with valid continents
+    return df[df['continent'].notna()].copy()
+
+
+def handle_missing_values(df):
+    df = df.sort_values(['location', 'date']).copy()
+
+    # Strategy 1: Forward fill cumulative metrics (by country)
+    cumulative_cols = ['total_cases', 'total_deaths', 'total_vaccinations',
+                       'people_vaccinated', 'people_fully_vaccinated']
+    for col in cumulative_cols:
+        if col in df.columns:
+            df[col] = df.groupby('location')[col].ffill()
+
+    # Strategy 2: Fill daily increments with 0
+    daily_cols = ['new_cases', 'new_deaths', 'new_vaccinations']
+    for col in daily_cols:
+        if col in df.columns:
+            df[col] = df[col].fillna(0)
+
+    # Strategy 3: Interpolate smoothed metrics
+    smoothed_cols = ['new_cases_smoothed', 'new_deaths_smoothed',
+                     'new_vaccinations_smoothed']
+    for col in smoothed_cols:
+        if col in df.columns:
+            df[col] = df.groupby('location')[col].transform(lambda x: x.interpolate(method='linear'))
+
+    # Strategy 4: Backward then forward fill for per capita metrics
+    per_capita_cols = ['total_cases_per_million', 'total_deaths_per_million',
+                       'new_cases_per_million', 'new_deaths_per_million']
+    for col in per_capita_cols:
+        if col in df.columns:
+            df[col] = df.groupby('location')[col].bfill().ffill()
+
+    return df
+
+
+def detect_anomalies(df):
+    df = df.sort_values(['location', 'date']).reset_index(drop=True)
+    flags = np.zeros(len(df), dtype=np.uint8)
+
+    for col, bits in ANOMALY_BITS.items():
+        values = df[col]
+        # Zero days are usually "not reported yet", so they are left out of the robust statistics
+        reported = values.where(values > 0)
+        grouped = reported.groupby(df['location'], sort=False)
+        median = grouped.rolling(ANOMALY_WINDOW, center=True, min_periods=ANOMALY_MIN_PERIODS).median().droplevel(0)
+        deviation = (reported - median).abs().groupby(df['location'], sort=False)
+        mad = deviation.rolling(ANOMALY_WINDOW, center=True, min_periods=ANOMALY_MIN_PERIODS).median().droplevel(0)
+
+        scale = np.maximum(1.4826 * mad, 0.1 * median).clip(lower=1.0)
+        robust_z = (values - median) / scale
+
+        flags[(robust_z > ANOMALY_THRESHOLD).to_numpy()] |= bits['spike']
+        flags[(values < 0).to_numpy()] |= bits['negative']
+
+    df['anomaly_flags'] = flags
+    return df
+
+
+def validate(df):
+    df = df.copy()
+    check_cols = ['total_cases', 'total_deaths', 'new_cases', 'new_deaths',
+                  'people_vaccinated', 'population']
+    for col in check_cols:
+        if col in df.columns:
+            neg_count = (df[col] < 0).sum()
+            if neg_count > 0:
+                print(f'      ⚠️  {neg_count} negative values in {col} clipped to 0')
+                df[col] = df[col].clip(lower=0)
+    return df
+
+
+STAGES = [
+    ('remove_aggregates', remove_aggregates),
+    ('missing_values', handle_missing_values),
+    ('anomalies', detect_anomalies),
+    ('validation', validate),
+]
+
+
+# =============================================================================
+# CACHING
+# =============================================================================
+def file_digest(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def stage_key(previous_key, func):
+    # Module constants (upper-case globals) the stage reads are part of its code
+    constants = sorted((name, func.__globals__[name]) for name in func.__code__.co_names
+                       if name.isupper() and name in func.__globals__)
+    return hashlib.sha256((previous_key + inspect.getsource(func) + repr(constants)).encode()).hexdigest()[:16]
+
+
+def cache_path(cache_dir, name, key):
+    return os.path.join(cache_dir, f'{name}-{key}.parquet')
+
+
+def store_stage(cache_dir, name, key, df):
+    os.makedirs(cache_dir, exist_ok=True)
+    # Keep only the newest output per stage
+    for stale in glob.glob(os.path.join(cache_dir, f'{name}-*.parquet')):
+        os.remove(stale)
+    df.to_parquet(cache_path(cache_dir, name, key), index=False)
+
+
+def read_marker(path):
+    try:
+        with open(path) as handle:
+            return handle.read()
+    except FileNotFoundError:
+        return None
+
+
+# =============================================================================
+# RUNNER
+# =============================================================================
+def run(input_path=RAW_PATH, output_path=OUTPUT_PATH, cache_dir=CACHE_DIR, force=False, store_path=None):
+    stages = [('ingest', ingest)] + STAGES
+    keys = []
+    previous = file_digest(input_path)
+    for _, func in stages:
+        previous = stage_key(previous, func)
+        keys.append(previous)
+
+    # Resume from the latest stage whose output is already cached
+    resume = -1
+    if not force:
+        for i in range(len(stages) - 1, -1, -1):
+            if os.path.exists(cache_path(cache_dir, stages[i][0], keys[i])):
+                resume = i
+                break
+
+    df = None
+    for i, ((name, func), key) in enumerate(zip(stages, keys)):
+        label = f'[{i + 1}/{len(stages)}] {name:20}'
+        if i < resume:
+            print(f'{label} skipped')
+            continue
+        started = time.perf_counter()
+        if i == resume:
+            df = pd.read_parquet(cache_path(cache_dir, name, key))
+            status = 'cached'
+        else:
+            df = func(input_path) if name == 'ingest' else func(df)
+            store_stage(cache_dir, name, key, df)
+            status = 'ran'
+        print(f'{label} {status:7} {len(df):>10,} rows  {time.perf_counter() - started:6.2f}s')
+
+    # Rewriting an unchanged export would only bump its mtime and invalidate the dashboard caches.
+    # The marker records the path it was written to, so exporting elsewhere is not skipped.
+    marker = os.path.join(cache_dir, f'export-{keys[-1]}.done')
+    if not force and os.path.exists(output_path) and read_marker(marker) == os.path.abspath(output_path):
+        print(f'[export] {output_path} is up to date')
+    else:
+        started = time.perf_counter()
+        df.to_csv(output_path, index=False)
+        for stale in glob.glob(os.path.join(cache_dir, 'export-*.done')):
+            os.remove(stale)
+        with open(marker, 'w') as handle:
+            handle.write(os.path.abspath(output_path))
+        print(f'[export] {output_path}  {df.shape}  {time.perf_counter() - started:.2f}s')
+
+    # The store records the export it mirrors; any other export (an earlier run without --store,
+    # or the notebook rewriting the CSV) makes it stale, and the dashboard then ignores it.
+    source = dict(source_signature(output_path), key=keys[-1])
+    manifest = read_manifest(store_path) if store_path else None
+    if store_path and (manifest is None or manifest.get('source') != source):
+        started = time.perf_counter()
+        manifest = write_store(df, store_path, source=source)
+        print(f'[store]  {store_path}  {sum(manifest["buckets"].values())} partitions  {time.perf_counter() - started:.2f}s')
+    print('✅ Pipeline complete')
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Regenerate the cleaned COVID-19 dataset.')
+    parser.add_argument('--input', default=RAW_PATH, help='raw OWID CSV (default: %(default)s)')
+    parser.add_argument('--output', default=OUTPUT_PATH, help='cleaned CSV to write (default: %(default)s)')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='stage cache directory (default: %(default)s)')
+    parser.add_argument('--force', action='store_true', help='ignore cached stage outputs')
+    parser.add_argument('--store', metavar='DIR', help='also write a partitioned Parquet store for the dashboard')
+    args = parser.parse_args()
+    run(args.input, args.output, args.cache_dir, args.force, args.store)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+"""Out-of-core query layer for the COVID-19 dashboard.
+
+The dashboard never holds the whole dataset in memory. Every view is answered by
+one of the queries below (filter, latest row per location, snapshots as of given
+dates, daily totals, top locations, monthly totals, daily pivot), run against either
+
+- a partitioned Parquet store on disk (``write_store`` / ``CovidStore.open``), or
+- an in-memory DataFrame (the cleaned CSV), through the same API.
+
+Store layout::
+
+    covid_store/
+        _manifest.json
+        data-<version>/continent=Europe/bucket=0/part-0.parquet
+        data-<version>/continent=Europe/bucket=1/part-0.parquet
+        ...
+
+A rebuild writes a new ``data-<version>`` directory next to the current one and
+then replaces the manifest atomically, so readers see either the old or the new
+store, never a partial one. The previous version is kept for readers that still
+have it open; older ones are deleted.
+
+Rows are partitioned by continent and by a stable hash bucket of the location, so
+each file holds the complete series of its locations. Queries are evaluated one
+file at a time: per-location logic (latest row, anomaly adjustment) is exact
+within a file, and partial aggregates from files are merged afterwards. Filters
+are pushed down to the scan: continent and location prune whole partitions, and
+the date range prunes row groups through Parquet statistics. Only the requested
+columns are read. Files are scanned on a small thread pool, with a bounded
+number in flight so memory stays proportional to a few files. ``close`` shuts the
+pool down once a store is superseded.
+"""
+import json
+import math
+import os
+import shutil
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+MANIFEST = '_manifest.json'
+TARGET_BUCKET_ROWS = 500_000
+ROW_GROUP_ROWS = 64_000
+MAX_RESULT_ROWS = 2_000_000
+SCAN_THREADS = 4
+KEY_COLUMNS = ['date', 'location', 'continent']
+
+
+class QueryTooLarge(Exception):
+    """Raised when a row-level query would return more than its row limit."""
+
+
+def location_bucket(location, buckets):
+    return zlib.crc32(str(location).encode('utf-8')) % buckets
+
+
+def source_signature(path):
+    """Size and modification time of the file a store is built from."""
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def built_from(manifest, path):
+    """Whether a store was built from the file at `path` as it is now."""
+    source = manifest.get('source') or {}
+    try:
+        signature = source_signature(path)
+    except FileNotFoundError:
+        return False
+    return all(source.get(name) == value for name, value in signature.items())
+
+
+def write_store(df, path, target_rows=TARGET_BUCKET_ROWS, source=None):
+    """Write a cleaned dataset as a partitioned Parquet store and return its manifest.
+
+    `source` describes what the data was built from (see ``built_from``) and is
+    recorded in the manifest as is.
+    """
+    df = df[df['continent'].notna()]
+    rows_per_continent = df.groupby('continent')['location'].size()
+    buckets = {continent: max(1, math.ceil(rows / target_rows)) for continent, rows in rows_per_continent.items()}
+
+    pairs = df[['location', 'continent']].drop_duplicates()
+    pairs['bucket'] = [location_bucket(loc, buckets[cont]) for loc, cont in zip(pairs['location'], pairs['continent'])]
+    frame = df.merge(pairs, on=['location', 'continent'], how='left', validate='many_to_one')
+    frame = frame.sort_values(['continent', 'bucket', 'date'], kind='stable')
+
+    version = uuid.uuid4().hex
+    data_dir = f'data-{version}'
+    previous = read_manifest(path) or {}
+    ds.write_dataset(
+        pa.Table.from_pandas(frame, preserve_index=False),
+        os.path.join(path, data_dir),
+        format='parquet',
+        partitioning=['continent', 'bucket'],
+        partitioning_flavor='hive',
+        max_rows_per_group=ROW_GROUP_ROWS,
+        min_rows_per_group=ROW_GROUP_ROWS // 2
+    )
+
+    # Written last and swapped in atomically: until then readers keep using the previous data
+    manifest = {
+        'version': version,
+        'data': data_dir,
+        'rows': int(len(frame)),
+        'buckets': {continent: int(n) for continent, n in buckets.items()},
+        'source': source
+    }
+    staged = os.path.join(path, MANIFEST + '.tmp')
+    with open(staged, 'w') as handle:
+        json.dump(manifest, handle, indent=1)
+    os.replace(staged, os.path.join(path, MANIFEST))
+
+    keep = {MANIFEST, data_dir, previous.get('data')}
+    for name in os.listdir(path):
+        stale = os.path.join(path, name)
+        if name in keep:
+            continue
+        if os.path.isdir(stale):
+            shutil.rmtree(stale)
+        else:
+            os.remove(stale)
+    return manifest
+
+
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, MANIFEST)) as handle:
+            return json.load(handle)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+class CovidStore:
+    def __init__(self, source, buckets=None, threads=SCAN_THREADS, max_rows=MAX_RESULT_ROWS, exclude=()):
+        # Columns in `exclude` are hidden from every query; `excluded` lists those the data had
+        names = source.columns if isinstance(source, pd.DataFrame) else source.schema.names
+        self.excluded = [name for name in names if name in exclude]
+        if isinstance(source, pd.DataFrame):
+            self._frame = source.drop(columns=self.excluded)
+            self._dataset = None
+        else:
+            self._frame = None
+            self._dataset = source
+        self._buckets = buckets or {}
+        self._threads = threads
+        self.max_rows = max_rows
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='store-scan')
+
+    def close(self):
+        """Shut down the scan pool. Scans still running finish; later ones run in the calling thread."""
+        self._pool.shutdown(wait=False)
+
+    @property
+    def columns(self):
+        if self._dataset is None:
+            return list(self._frame.columns)
+        return [name for name in self._dataset.schema.names if name != 'bucket' and name not in self.excluded]
+
+    def arrow_schema(self):
+        if self._dataset is None:
+            return pa.Schema.from_pandas(self._frame, preserve_index=False)
+        return pa.schema([self._dataset.schema.field(name) for name in self.columns])
+
+    @classmethod
+    def open(cls, path, **kwargs):
+        manifest = read_manifest(path)
+        if manifest is None:
+            raise FileNotFoundError(f'No store manifest in {path}')
+        # Stores written before versioned data directories keep their partitions at the top level
+        dataset = ds.dataset(os.path.join(path, manifest.get('data', '')), format='parquet',
+                             partitioning='hive', exclude_invalid_files=True)
+        return cls(dataset, buckets=manifest['buckets'], **kwargs)
+
+    # -------------------------------------------------------------------------
+    # Scanning
+    # -------------------------------------------------------------------------
+    def _expression(self, start_date, end_date, continent, locations):
+        expr = ds.scalar(True)
+        if start_date is not None:
+            expr = expr & (ds.field('date') >= pa.scalar(pd.Timestamp(start_date), type=pa.timestamp('ns')))
+        if end_date is not None:
+            expr = expr & (ds.field('date') <= pa.scalar(pd.Timestamp(end_date), type=pa.timestamp('ns')))
+        if continent not in (None, 'All'):
+            expr = expr & (ds.field('continent') == continent)
+        if locations is not None:
+            locations = list(locations)
+            expr = expr & ds.field('location').isin(locations)
+            # Partition pruning: only the buckets these locations hash to
+            bucket_expr = None
+            for name, n in self._buckets.items():
+                ids = sorted({location_bucket(loc, n) for loc in locations})
+                part = (ds.field('continent') == name) & ds.field('bucket').isin(ids)
+                bucket_expr = part if bucket_expr is None else (bucket_expr | part)
+            if bucket_expr is not None:
+                expr = expr & bucket_expr
+        return expr
+
+    def _slice_frame(self, start_date, end_date, continent, locations, columns):
+        data = self._frame
+        mask = pd.Series(True, index=data.index)
+        if start_date is not None:
+            mask &= data['date'] >= start_date
+        if end_date is not None:
+            mask &= data['date'] <= end_date
+        if continent not in (None, 'All'):
+            mask &= data['continent'] == continent
+        if locations is not None:
+            mask &= data['location'].isin(list(locations))
+        return data.loc[mask, columns] if columns is not None else data[mask]
+
+    def _read_fragment(self, fragment, expr, columns):
+        table = fragment.to_table(schema=self._dataset.schema, columns=columns, filter=expr, use_threads=True)
+        return table.to_pandas()
+
+    def _units(self, start_date, end_date, continent, locations, columns):
+        if columns is not None:
+            columns = list(dict.fromkeys(KEY_COLUMNS + list(columns)))
+        elif self._dataset is not None:
+            columns = self.columns
+        if self._dataset is None:
+            yield partial(self._slice_frame, start_date, end_date, continent, locations, columns)
+            return
+        expr = self._expression(start_date, end_date, continent, locations)
+        for fragment in self._dataset.get_fragments(filter=expr):
+            yield partial(self._read_fragment, fragment, expr, columns)
+
+    def _submit(self, fn, *args):
+        try:
+            return self._pool.submit(fn, *args)
+        except RuntimeError:
+            # Closed while a query was in flight
+            future = Future()
+            future.set_result(fn(*args))
+            return future
+
+    def frames(self, start_date, end_date, continent='All', locations=None, columns=None,
+               prepare=None, prepare_columns=(), margin_days=0):
+        """Yield location-complete DataFrames for the filter, one per storage file.
+
+        ``prepare`` runs on each frame before it is trimmed to the date range; the
+        frame is read ``margin_days`` wider on both sides so per-location rolling
+        logic in ``prepare`` sees its neighbours at the edges of the range.
+        ``prepare_columns`` are added to the projection for ``prepare``.
+        """
+        margin = pd.Timedelta(days=margin_days)
+        if columns is not None and prepare is not None:
+            columns = list(dict.fromkeys(list(columns) + list(prepare_columns)))
+
+        def load(unit):
+            frame = unit()
+            if prepare is not None and len(frame):
+                frame = prepare(frame)
+            if margin_days:
+                frame = frame[(frame['date'] >= start_date) & (frame['date'] <= end_date)]
+            return frame
+
+        units = self._units(
+            None if start_date is None else start_date - margin,
+            None if end_date is None else end_date + margin,
+            continent, locations, columns
+        )
+        pending = deque()
+        for unit in units:
+            pending.append(self._submit(load, unit))
+            if len(pending) >= self._threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    # -------------------------------------------------------------------------
+    # Queries
+    # -------------------------------------------------------------------------
+    def scan(self, start_date, end_date, continent='All', locations=None, columns=None, max_rows=None, **kwargs):
+        limit = self.max_rows if max_rows is None else max_rows
+        parts, rows = [], 0
+        for frame in self.frames(start_date, end_date, continent, locations, columns, **kwargs):
+            rows += len(frame)
+            if rows > limit:
+                raise QueryTooLarge(f'Query returns more than {limit:,} rows; narrow the date range or selection.')
+            parts.append(frame)
+        return pd.concat(parts, ignore_index=True) if parts else self._empty(columns)
+
+    def latest(self, start_date, end_date, continent='All', columns=None, **kwargs):
+        # Last non-null value of every column per location (pandas groupby.last semantics)
+        parts = [
+            frame.sort_values('date').groupby('location').last().reset_index()
+            for frame in self.frames(start_date, end_date, continent, columns=columns, **kwargs)
+            if len(frame)
+        ]
+        return pd.concat(parts, ignore_index=True) if parts else self._empty(columns)
+
+    def latest_as_of(self, dates, continent='All', columns=None, **kwargs):
+        # Per location and date: the last non-null value of every column on or before that date.
+        # Values are carried forward within each location once, then every (date, location) pair
+        # is matched to its last row in one sorted merge_asof, whatever the number of dates.
+        dates = pd.DatetimeIndex(dates).sort_values()
+        parts = []
+        for frame in self.frames(None, dates.max(), continent, columns=columns, **kwargs):
+            if not len(frame):
+                continue
+            frame = frame.sort_values('date', kind='stable')
+            filled = frame.groupby('location', sort=False).ffill()
+            filled.insert(0, 'location', frame['location'])
+            targets = pd.MultiIndex.from_product(
+                [dates.astype(filled['date'].dtype), np.sort(frame['location'].unique())], names=['as_of', 'location']
+            ).to_frame(index=False)
+            snapshot = pd.merge_asof(targets, filled, left_on='as_of', right_on='date', by='location', direction='backward')
+            # Locations with no row yet on a date are left out, as groupby would
+            snapshot = snapshot[snapshot['date'].notna()]
+            parts.append(snapshot[list(filled.columns) + ['as_of']])
+        return pd.concat(parts, ignore_index=True) if parts else self._empty(columns).assign(as_of=pd.NaT)
+
+    def daily_totals(self, values, start_date, end_date, continent='All', **kwargs):
+        parts = [
+            frame.groupby('date')[values].sum()
+            for frame in self.frames(start_date, end_date, continent, columns=values, **kwargs)
+        ]
+        if not parts:
+            return pd.DataFrame(columns=['date'] + list(values))
+        return pd.concat(parts).groupby(level=0).sum().sort_index().reset_index()
+
+    def top_locations(self, value, n, start_date, end_date, continent='All', **kwargs):
+        parts = [
+            frame.groupby('location')[value].max()
+            for frame in self.frames(start_date, end_date, continent, columns=[value], **kwargs)
+        ]
+        if not parts:
+            return []
+        return pd.concat(parts).nlargest(n).index.tolist()
+
+    def monthly_totals(self, value, locations, start_date, end_date, continent='All', **kwargs):
+        parts = []
+        for frame in self.frames(start_date, end_date, continent, locations=locations, columns=[value], **kwargs):
+            month = frame['date'].dt.to_period('M').astype(str)
+            parts.append(frame.groupby(['location', month])[value].sum())
+        if not parts:
+            return pd.DataFrame()
+        totals = pd.concat(parts).groupby(level=[0, 1]).sum()
+        totals.index.names = ['location', 'month']
+        return totals.unstack('month').fillna(0)
+
+    def pivot_daily(self, values, start_date, end_date, continent='All', **kwargs):
+        # (date x location) grid per value; locations never span files, so parts join side by side
+        parts = [
+            frame.pivot(index='date', columns='location', values=values)
+            for frame in self.frames(start_date, end_date, continent, columns=values, **kwargs)
+            if len(frame)
+        ]
+        if not parts:
+            return pd.DataFrame()
+        return pd.concat(parts, axis=1).sort_index()
+
+    def catalog(self):
+        # One row per location: continent, first and last reported date
+        parts = [
+            frame.groupby(['location', 'continent'])['date'].agg(['min', 'max'])
+            for frame in self.frames(None, None, columns=[])
+        ]
+        catalog = pd.concat(parts) if parts else pd.DataFrame(columns=['min', 'max'])
+        return catalog.rename(columns={'min': 'first_date', 'max': 'last_date'}).reset_index()
+
+    def _empty(self, columns):
+        if self._frame is not None:
+            return self._frame.iloc[:0] if columns is None else self._frame[list(dict.fromkeys(KEY_COLUMNS + list(columns)))].iloc[:0]
+        names = self.columns if columns is None else list(dict.fromkeys(KEY_COLUMNS + list(columns)))
+        return self._dataset.schema.empty_table().select(names).to_pandas()